@@ -1,5 +1,18 @@
 import ast
-from lark import Lark, Transformer, v_args
+import re
+import sys
+from typing import Any, NamedTuple
+from functools import lru_cache
+from lark import Lark, Transformer_NonRecursive, v_args
+from lark.exceptions import UnexpectedCharacters
+
+# lark_cython (optional) provides a compiled lexer and LALR parser. Its tokens
+# are not str instances, so the transformer always reads token.value
+try:
+    import lark_cython
+    _LARK_OPTIONS = {"_plugins": lark_cython.plugins}
+except ImportError:
+    _LARK_OPTIONS = {}
 
 # Class allows to strucutre correctly $filter expression returning back
 # a tree of dictionaries with logical and comparision expressions
@@ -17,24 +30,21 @@ odata_filter_grammar = r"""
     ?and_expr: not_expr
             | and_expr "and" not_expr -> and_expr
 
-    ?not_expr: "not" atom             -> not_expr
-            | atom
+    ?not_expr: "not" comparison       -> not_expr
+            | comparison
 
+    ?comparison: atom OPERATOR comparison -> comparison_expr
+            | atom
 
-    ?atom: comparison
-         | function_call
+    ?atom: function_call
          | field
          | value
          | "(" expr ")"
 
-    ?comparison: atom operator atom   -> comparison_expr
-
-    function_call: FUNC_NAME "(" [args] ")"
-    field: path
-    path: NAME ("/" NAME)*
+    function_call: FUNC_NAME "(" (expr ("," expr)*)? ")"
+    field: FIELD_PATH
 
     OPERATOR: "eq" | "ne" | "gt" | "lt" | "ge" | "le" | "add" | "sub" | "mul" | "div" | "mod" 
-    operator: OPERATOR
 
     value: SIGNED_NUMBER      -> number
          | ESCAPED_STRING     -> string  
@@ -47,88 +57,287 @@ odata_filter_grammar = r"""
     SINGLE_QUOTED_STRING: /'(?:[^']|'')*'/
 
 
-    FUNC_NAME.2: "startswith" | "endswith" | "contains" | "substringof" | "now"
-               | "length" | "indexof" | "tolower" | "toupper" | "trim"
-               | "concat" | "year" | "month" | "day" | "hour" | "minute" | "second"
-                   
-    args: expr ("," expr)*
+    // Whole words only, fields like daylight or nowhere are not split after a function name
+    FUNC_NAME.2: /(?:startswith|endswith|contains|substringof|now|length|indexof|tolower|toupper|trim|concat|year|month|day|hour|minute|second)(?![a-zA-Z0-9_])/
 
-    NAME: /[a-zA-Z_][a-zA-Z0-9_]*/
+
+    // Whole navigation path is one token (whitespace around / is allowed, as between other tokens)
+    FIELD_PATH: /[a-zA-Z_][a-zA-Z0-9_]*(?:[ \t\f\r\n]*\/[ \t\f\r\n]*[a-zA-Z_][a-zA-Z0-9_]*)*/
 
     %import common.SIGNED_NUMBER
     %import common.ESCAPED_STRING
     %import common.WS
     %ignore WS
 """
-class ODataPrimitve:
-    def __init__(self,value):
-        self.value = value
-
-class ODataFunction:
-    def __init__(self,name,args):
-        self.name = name
-        self.args = args
-
-class ODataField:
-    def __init__(self,name):
-        self.name = name
-
-class ODataOperator:
-    def __init__(self,name,a,b):
-        self.name = name
-        self.a = a
-        self.b = b
-class ODataLogOperator:
-    def __init__(self,name,left,right):
-        self.name = name
-        self.right = right
-        self.left = left
+# Expression nodes are immutable named tuples: as compact as plain tuples,
+# but consumers keep accessing them by attribute name
+class ODataPrimitve(NamedTuple):
+    value: Any
+
+class ODataFunction(NamedTuple):
+    name: str
+    args: tuple
+
+class ODataField(NamedTuple):
+    name: str
+    path: tuple = ()
+
+class ODataOperator(NamedTuple):
+    name: str
+    a: Any
+    b: Any
+
+class ODataLogOperator(NamedTuple):
+    name: str
+    operands: tuple
+
+class ODataNotOperator(NamedTuple):
+    expr: Any
+    name = "not"
+
+# Escaped double quoted literals still go through literal_eval (a unicode_escape
+# decode would mangle non ASCII text), but each distinct literal is evaluated once
+_unescape = lru_cache(maxsize=1024)(ast.literal_eval)
+
+# Interned operator names, every comparison node shares one of these strings
+_OPERATORS = {op: sys.intern(op) for op in ("eq", "ne", "gt", "lt", "ge", "le", "add", "sub", "mul", "div", "mod")}
+
+def _log_operator(name, left, right):
+    """Builds n-ary and/or node, chains of the same operator are merged into one node"""
+    operands = left.operands if type(left) == ODataLogOperator and left.name == name else (left,)
+    if type(right) == ODataLogOperator and right.name == name:
+        return ODataLogOperator(name, operands + right.operands)
+    return ODataLogOperator(name, operands + (right,))
+
+# Wrappers for small integer literals (ids, flags, etc.) are shared between parses
+_SMALL_INT = {i: ODataPrimitve(i) for i in range(-5, 257)}
+_TRUE = ODataPrimitve(True)
+_FALSE = ODataPrimitve(False)
+_NULL = ODataPrimitve(None)
+
+def _number(text):
+    # integer literals stay ints, only fractions and exponents become floats
+    if text.lstrip('+-').isdigit():
+        value = int(text)
+        if value in _SMALL_INT:
+            return _SMALL_INT[value]
+        return ODataPrimitve(value)
+    return ODataPrimitve(float(text))
+
+def _string(text):
+    if text.startswith('"'):
+        if '\\' not in text:
+            return ODataPrimitve(text[1:-1])  # nothing to unescape
+        return ODataPrimitve(_unescape(text))  # handles \" correctly
+    # Remove outer quotes and replace doubled single quotes with one
+    return ODataPrimitve(text[1:-1].replace("''", "'"))
+
+def _field(parts):
+    # field names repeat a lot between filters, interned names share memory;
+    # keep both the joined name and the already split segments
+    path = tuple(map(sys.intern, parts))
+    if len(path) == 1:
+        return ODataField(path[0], path)
+    return ODataField(sys.intern("/".join(path)), path)
+
 @v_args(inline=True)
-class ODataFilterTransformer(Transformer):
+class ODataFilterTransformer(Transformer_NonRecursive):
     def and_expr(self, left, right):
-        return ODataLogOperator("and",left,right)
+        return _log_operator("and",left,right)
 
     def or_expr(self, left, right):
-        return ODataLogOperator("or",left,right)
+        return _log_operator("or",left,right)
 
     def not_expr(self, expr):
-        return  ODataLogOperator("not",None,expr)
+        return ODataNotOperator(expr)
 
     def comparison_expr(self, field, op, value):
-        return ODataOperator(str(op),field,value)
+        return ODataOperator(_OPERATORS[op.value],field,value)
 
-    def function_call(self, name, args=None):
-        args = args if args else []
-        return ODataFunction( str(name),args)
-
-    def args(self, *expressions):
-        return list(expressions)
-
-    def operator(self, token):
-        return str(token)
+    def function_call(self, name, *args):
+        return ODataFunction(name.value,args)
 
     def number(self, token):
-        return ODataPrimitve(float(token))
+        return _number(token.value)
 
     def string(self, token):
-        text = str(token)
-        if text.startswith('"'):
-            return ODataPrimitve(ast.literal_eval(text))  # handles \" correctly
-        elif text.startswith("'"):
-            # Remove outer quotes and replace doubled single quotes with one
-            return ODataPrimitve(text[1:-1].replace("''", "'"))
-
+        return _string(token.value)
 
     def true(self):
-        return ODataPrimitve(True)
+        return _TRUE
 
     def false(self):
-        return ODataPrimitve(False)
+        return _FALSE
     def null(self):
-        return ODataPrimitve(None)
+        return _NULL
     
-    def path(self, *parts):
-        return "/".join(str(p) for p in parts)
-
-    def field(self, value):
-        return ODataField(value)  # just pass through the transformed path
\ No newline at end of file
+    def field(self, token):
+        path = token.value
+        if "/" not in path:
+            return _field((path,))
+        return _field([part.strip(" \t\f\r\n") for part in path.split("/")])
+
+# Transformer is applied inline during LALR reductions, so no intermediate
+# Tree objects are built
+_TRANSFORMER = ODataFilterTransformer()
+
+# The parser is built once per process; cache=True additionally stores the
+# LALR tables on disk so new processes skip the grammar analysis as well.
+# Terminals only use plain re syntax, so the stdlib re module is enough
+_PARSER = Lark(odata_filter_grammar, parser='lalr', lexer='contextual', transformer=_TRANSFORMER, regex=False,
+               maybe_placeholders=False, propagate_positions=False, cache=True, **_LARK_OPTIONS)
+
+# Longest prefix made of complete string literals and characters the other
+# terminals of the grammar consist of (names, numbers, whitespace, punctuation).
+# One character or literal per step, so a mismatch never backtracks
+_VALID_PREFIX_RE = re.compile(r"""(?:[\w\s(),/.+\-]|'(?:[^']|'')*'|"(?:[^"\\\n]|\\.)*")*""")
+
+def _check_characters(text: str):
+    """Raises the lexer error for a character no terminal accepts, before the Lark parser runs"""
+    end = _VALID_PREFIX_RE.match(text).end()
+    if end != len(text):
+        line = text.count("\n", 0, end) + 1
+        column = end - text.rfind("\n", 0, end)
+        raise UnexpectedCharacters(text, end, line, column)
+
+class _NotHandled(Exception):
+    pass
+
+# Function names of the grammar (FUNC_NAME), literal keywords and terminals
+_FUNC_NAMES = frozenset(("startswith", "endswith", "contains", "substringof", "now",
+                         "length", "indexof", "tolower", "toupper", "trim",
+                         "concat", "year", "month", "day", "hour", "minute", "second"))
+_KEYWORDS = {"true": _TRUE, "false": _FALSE, "null": _NULL}
+_RESERVED = frozenset(("and", "or", "not"))
+
+_TOKEN_RE = re.compile(r"""
+      (?P<ws>[ \t\f\r\n]+)
+    | (?P<string>'(?:[^']|'')*'|"(?:[^"\\\n]|\\.)*")
+    | (?P<number>[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)
+    | (?P<name>[a-zA-Z_][a-zA-Z0-9_]*)
+    | (?P<punct>[()/,])
+""", re.VERBOSE)
+
+_END = ("end", "")
+
+class _ODataFilterParser:
+    """Hand written recursive descent parser for $filter expressions
+
+    Produces exactly the same trees as the Lark grammar, but avoids the generic
+    LALR machinery for the usual short filters. It accepts a subset of what the
+    grammar accepts: whatever it does not recognise (or what the grammar might
+    reject) raises _NotHandled and is left to the Lark parser, which stays the
+    authority on valid filters and also reports errors.
+    """
+    __slots__ = ("tokens", "pos")
+
+    def __init__(self, text: str):
+        self.tokens = []
+        pos, end = 0, len(text)
+        while pos < end:
+            m = _TOKEN_RE.match(text, pos)
+            if m is None:
+                raise _NotHandled()
+            if m.lastgroup != "ws":
+                self.tokens.append((m.lastgroup, m.group()))
+            pos = m.end()
+        self.tokens.append(_END)
+        self.pos = 0
+
+    def _next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _accept(self, kind, value):
+        if self.tokens[self.pos] == (kind, value):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, kind, value):
+        if not self._accept(kind, value):
+            raise _NotHandled()
+
+    def parse(self):
+        expr = self.or_expr()
+        if self.tokens[self.pos] != _END:
+            raise _NotHandled()
+        return expr
+
+    def or_expr(self):
+        expr = self.and_expr()
+        while self._accept("name", "or"):
+            expr = _log_operator("or", expr, self.and_expr())
+        return expr
+
+    def and_expr(self):
+        expr = self.not_expr()
+        while self._accept("name", "and"):
+            expr = _log_operator("and", expr, self.not_expr())
+        return expr
+
+    def not_expr(self):
+        if self._accept("name", "not"):
+            return ODataNotOperator(self.comparison())
+        return self.comparison()
+
+    def comparison(self):
+        # comparisons chain to the right, same as in the grammar
+        left = self.atom()
+        kind, value = self.tokens[self.pos]
+        if kind == "name" and value in _OPERATORS:
+            self.pos += 1
+            return ODataOperator(_OPERATORS[value], left, self.comparison())
+        return left
+
+    def atom(self):
+        kind, value = self._next()
+        if kind == "name":
+            if value in _KEYWORDS:
+                return _KEYWORDS[value]
+            if value in _RESERVED:
+                raise _NotHandled()
+            if value in _FUNC_NAMES:
+                # the grammar lexes these words as function names only, never as fields
+                if not self._accept("punct", "("):
+                    raise _NotHandled()
+                args = []
+                if not self._accept("punct", ")"):
+                    args.append(self.or_expr())
+                    while self._accept("punct", ","):
+                        args.append(self.or_expr())
+                    self._expect("punct", ")")
+                return ODataFunction(value, tuple(args))
+            parts = [value]
+            while self._accept("punct", "/"):
+                kind, value = self._next()
+                if kind != "name":
+                    raise _NotHandled()
+                parts.append(value)
+            return _field(parts)
+        if kind == "number":
+            return _number(value)
+        if kind == "string":
+            return _string(value)
+        if kind == "punct" and value == "(":
+            expr = self.or_expr()
+            self._expect("punct", ")")
+            return expr
+        raise _NotHandled()
+
+# Clients tend to resend the same expressions (paging, polling), so parsed
+# results are memoized. Cached results are shared and must not be modified
+@lru_cache(maxsize=4096)
+def parse_filter(text: str):
+    """Parses $filter expression into a tree of OData objects
+
+    Args:
+        text    $filter expression
+    """
+    try:
+        return _ODataFilterParser(text).parse()
+    except (_NotHandled, RecursionError):
+        # stray characters (e.g. ; or * of injection attempts) are rejected cheaply
+        _check_characters(text)
+        return _PARSER.parse(text)
@@ -1,11 +1,29 @@
 
+import copy
 import re
+from functools import lru_cache
 from typing import Deque, Dict, List, Any, Optional, Union, Callable, Tuple, Set
 from urllib.parse import urlparse, parse_qs,unquote
-from lark import Lark
-from  odata.path import ODataPathTransformer , odata_path_grammar
-from  odata.filter import ODataFilterTransformer , odata_filter_grammar
-from  odata.orderby import ODataOrderByTransformer, odata_orderby_grammar
+from  odata.path import parse_path
+from  odata.filter import parse_filter
+from  odata.orderby import parse_orderby
+
+# Entity (navigation property) name
+_ENTITY_RE = re.compile(r"[a-zA-Z_]\w*\Z", re.ASCII)
+
+# Characters which make smart_split necessary for query strings (% can decode to any of the others)
+_SPLIT_RESERVED_RE = re.compile(r"""[()'"%]""")
+
+# Quoted strings with escapes, unterminated ones run to the end of the text
+_QUOTED = {
+    "'": re.compile(r"""'[^'\\]*(?:\\.[^'\\]*)*'?""", re.DOTALL),
+    '"': re.compile(r""""[^"\\]*(?:\\.[^"\\]*)*"?""", re.DOTALL),
+}
+
+@lru_cache(maxsize=None)
+def _split_scanner(splitter:str):
+    """Pattern finding the characters smart_split has to look at outside quoted strings"""
+    return re.compile(r"""['"()]|""" + re.escape(splitter))
 
 # These OData parser classes allow to parse correctly OData url + queries, both regex and lark are used to correctly form a strucutre of the request
 
@@ -24,20 +42,22 @@ class ODataURLParser:
         if query_string.startswith('?'):
             query_string = query_string[1:]
         
-        # URL decode the string first
-        decoded = unquote(query_string)
-        
-        # Split on & but ignore & inside parentheses
-        params = ODataURLParser.smart_split(decoded,'&')
+        if _SPLIT_RESERVED_RE.search(query_string) is None:
+            # Nothing encoded, quoted or in parentheses (e.g. $top=10&$skip=20&$select=a,b):
+            # every & separates parameters
+            params = [param for param in map(str.strip, query_string.split('&')) if param]
+        else:
+            # URL decode the string first
+            decoded = unquote(query_string)
+            
+            # Split on & but ignore & inside parentheses
+            params = ODataURLParser.smart_split(decoded,'&')
         
         result = {}
         for param in params:
-            if '=' in param:
-                key, value = param.split('=', 1)  # Split only on first =
-                if key in result:
-                    result[key].append(value)
-                else:
-                    result[key] = [value]
+            key, sep, value = param.partition('=')  # Split only on first =
+            if sep:
+                result.setdefault(key, []).append(value)
             else:
                 # Parameter without value
                 result[param] = ['']
@@ -56,49 +76,41 @@ class ODataURLParser:
             list: List of split parts with whitespace stripped
         """
         result = []
-        current_part = ""
+        search = _split_scanner(splitter).search
+        # start of the current part, scanning position
+        start = pos = 0
         paren_depth = 0
-        in_single_quote = False
-        in_double_quote = False
-        i = 0
         
-        while i < len(text):
-            char = text[i]
-            
-            # Handle escape sequences in quotes
-            if (in_single_quote or in_double_quote) and char == '\\' and i + 1 < len(text):
-                current_part += char + text[i + 1]
-                i += 2
-                continue
-            
-            # Handle quote toggling
-            if char == '"' and not in_single_quote:
-                in_double_quote = not in_double_quote
-                current_part += char
-            elif char == "'" and not in_double_quote:
-                in_single_quote = not in_single_quote
-                current_part += char
+        # Only quotes, parentheses and splitters change the state, text between them is
+        # skipped by the regex engine and taken as one slice
+        while True:
+            match = search(text, pos)
+            if match is None:
+                break
+            char = match.group()
+            i = match.start()
+            pos = i + 1
+
             # Handle parentheses (only when not in quotes)
-            elif char == '(' and not (in_single_quote or in_double_quote):
+            if char == '(':
                 paren_depth += 1
-                current_part += char
-            elif char == ')' and not (in_single_quote or in_double_quote):
+            elif char == ')':
                 paren_depth -= 1
-                current_part += char
-            # Handle ampersand splitting
-            elif char == splitter and paren_depth == 0 and not (in_single_quote or in_double_quote):
-                # We found an ampersand outside of parentheses and quotes
-                if current_part.strip():
-                    result.append(current_part.strip())
-                current_part = ""
+            # We found a splitter outside of parentheses and quotes
+            elif char == splitter:
+                if paren_depth == 0:
+                    part = text[start:i].strip()
+                    if part:
+                        result.append(part)
+                    start = pos
+            # Quoted string (escapes included) is skipped in one step
             else:
-                current_part += char
-            
-            i += 1
+                pos = _QUOTED[char].match(text, i).end()
         
         # Add the last part
-        if current_part.strip():
-            result.append(current_part.strip())
+        part = text[start:].strip()
+        if part:
+            result.append(part)
         
         return result
 
@@ -124,19 +136,12 @@ class ODataURLParser:
                 return []
             
             s = s.strip().strip('/')
-            entities = []
             
-            # Split by commas, but we need to be careful about commas inside parentheses
+            # Split by commas, but we need to be careful about commas inside parentheses,
+            # parts are already stripped and not empty
             parts = ODataURLParser.smart_split(s,',')
             
-            for part in parts:
-                part = part.strip()
-                if part:
-                    entity, params = ODataURLParser.extract_single_entity(part)
-                    if entity:
-                        entities.append((entity, params))
-            
-            return entities
+            return [entity for entity in map(ODataURLParser.extract_single_entity, parts) if entity[0]]
 
     def extract_single_entity(s: str):
         """
@@ -146,14 +151,12 @@ class ODataURLParser:
         
         if paren_pos == -1:
             # No parentheses
-            if re.match(r"^[a-zA-Z_][a-zA-Z0-9_]*$", s):
-                return s, None
             return s, None
         
         entity = s[:paren_pos]
         
         # Validate entity name
-        if not re.match(r"^[a-zA-Z_][a-zA-Z0-9_]*$", entity):
+        if not _ENTITY_RE.match(entity):
             return None, None
         
         # Extract content between parentheses
@@ -181,6 +184,18 @@ class ODataURLParser:
         entities = ODataURLParser.parse_multiple_entities(s)
         return {entity: params for entity, params in entities}
 
+    def extract_expand_segment(s: str):
+        """
+        Extract entity name and parameters of one $expand segment (already split by top level commas),
+        (None, None) if it is not valid.
+        """
+        s = s.strip().strip('/').strip()
+        if s:
+            entity, params = ODataURLParser.extract_single_entity(s)
+            if entity:
+                return entity, params
+        return None, None
+
     def extract_expand(s: str):
         # Handle multiple entities by taking the first one
         entities = ODataURLParser.parse_multiple_entities(s)
@@ -226,65 +241,98 @@ class ODataParser:
         #self.compute = None
         #self.apply = None
         self.parsed_path = None
+        self._has_params = False
     
 
+    @classmethod
+    def cached(cls,url:str):
+        """Returns already run parser for the url, parsing it only the first time
+
+        Result is a shallow copy of the cached parser: scalar values (skip, top, ...)
+        can be reassigned freely, parsed structures are shared and must not be modified
+
+        Args:
+            url    OData url
+        """
+        return copy.copy(_parse_url(url))
+
     def has_parameters(self) -> bool:
         if self.filter or self.select or self.orderby or self.top or self.skip or self.count or self.search:
             return True
         return False
+    def _set_int(self,name:str,value:str):
+        try:
+            setattr(self, name, int(value))
+        except ValueError:
+            pass
+
+    def _parse_count(self,value:str):
+        self.count = value == "true"
+
+    def _parse_top(self,value:str):
+        self._set_int("top", value)
+
+    def _parse_skip(self,value:str):
+        self._set_int("skip", value)
+
+    def _parse_skiptoken(self,value:str):
+        self._set_int("skip_token", value)
+
+    def _parse_expand(self,value:str):
+        # Segments are split once, each one holds a single entity with its options
+        exp_segments = ODataURLParser.smart_split(value,',')
+        self.expand = [ODataURLParser.extract_expand_segment(seg) for seg in exp_segments]
+
+    def _parse_select(self,value:str):
+        self.select = value.split(',')
+
+    def _parse_search(self,value:str):
+        self.search = value
+
+    def _parse_format(self,value:str):
+        self.format = value
+
+    #complex  parsing
+    def _parse_filter(self,value:str):
+        self.filter = parse_filter(value)
+
+    def _parse_orderby(self,value:str):
+        self.orderby = parse_orderby(value)
+
+    # Handlers of the supported parameters, called with the first value of the parameter
+    _PARAM_HANDLERS = {
+        "$count": _parse_count,
+        "$top": _parse_top,
+        "$skip": _parse_skip,
+        "$skiptoken": _parse_skiptoken,
+        "$expand": _parse_expand,
+        "$select": _parse_select,
+        "$search": _parse_search,
+        "$format": _parse_format,
+        "$filter": _parse_filter,
+        "$orderby": _parse_orderby,
+    }
+
     def run(self):
 
+        # Only parameters present in the url are visited
+        handlers = self._PARAM_HANDLERS
+        for name, values in self.params.items():
+            handler = handlers.get(name)
+            if handler is not None:
+                handler(self, values[0])
 
-        if "$count" in self.params:
-            if self.params["$count"][0] == "true":
-                self.count = True
-            else:
-                self.count = False
-        if "$top" in self.params:
-            try:
-                self.top = int(self.params["$top"][0])
-            except:
-                pass
-        if "$skip" in self.params:
-            try:
-                self.skip = int(self.params["$skip"][0])
-            except:
-                pass
-        if "$skiptoken" in self.params:
-            try:
-                self.skip_token = int(self.params["$skiptoken"][0])
-            except:
-                pass
-        if "$expand" in self.params:
-            self.expand = []
-
-            exp_segments = ODataURLParser.smart_split(self.params["$expand"][0],',')
-            for seg in exp_segments:
-
-                field , nested = ODataURLParser.extract_expand(seg)
-
-                self.expand.append((field , nested ))
-
-        if "$select" in self.params:
-            self.select = self.params["$select"][0].split(',')
-
-        if "$search" in self.params:
-            self.search = self.params["$search"][0]
-
-        if "$format" in self.params:
-            self.format = self.params["$format"][0]
-
-        #complex  parsing
-        if "$filter" in self.params:
-            parser_filter = Lark(odata_filter_grammar, parser='lalr', transformer=ODataFilterTransformer())
-            self.filter = parser_filter.parse(self.params["$filter"][0])
-            #print(self.filter)
-
-        if "$orderby" in self.params:
-            parser_orderby = Lark(odata_orderby_grammar, parser='lalr', transformer=ODataOrderByTransformer())
-            self.orderby = parser_orderby.parse(self.params["$orderby"][0])
-
-        parser_path = Lark(odata_path_grammar, parser='lalr', transformer=ODataPathTransformer())
-        self.parsed_path = parser_path.parse(self.path)
+        self.parsed_path = parse_path(self.path)
+
+        # Parsed parameters do not change after run, mutations check this flag
+        self._has_params = self.has_parameters()
 
 
+# Same urls (paging, polling, expands of sub queries) are requested over and over,
+# keep the last parsed ones. $filter and path parsing are additionally memoized by
+# expression text, so urls differing only in $top/$skip still share that work
+@lru_cache(maxsize=1024)
+def _parse_url(url:str) -> ODataParser:
+    parser = ODataParser(url)
+    parser.run()
+    return parser
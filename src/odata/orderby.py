@@ -1,3 +1,4 @@
+from functools import lru_cache
 from lark import Lark, Transformer, v_args
 
 odata_orderby_grammar = r"""
@@ -23,7 +24,7 @@ class ODataOrderByTransformer(Transformer):
     def orderby_entry(self, items):
         field = items[0]
         direction = items[1] if len(items) > 1 else "asc"
-        return {str(field): str(direction)}
+        return (str(field), str(direction))
 
     def path(self, items):
         return "/".join(str(p) for p in items)
@@ -32,7 +33,25 @@ class ODataOrderByTransformer(Transformer):
         return str(items[0])
 
     def orderby_list(self, items):
-        result = {}
-        for item in items:
-            result.update(item)
-        return result
+        # entries keep the order of the expression
+        return list(items)
+
+
+# Transformer is stateless, one shared instance is enough for every parse
+_TRANSFORMER = ODataOrderByTransformer()
+
+# The parser is built once per process; cache=True additionally stores the
+# LALR tables on disk so new processes skip the grammar analysis as well
+_PARSER = Lark(odata_orderby_grammar, parser='lalr', transformer=_TRANSFORMER, regex=False,
+               maybe_placeholders=False, propagate_positions=False, cache=True)
+
+# Clients tend to resend the same expressions (paging, polling), so parsed
+# results are memoized. Cached results are shared and must not be modified
+@lru_cache(maxsize=4096)
+def parse_orderby(text: str):
+    """Parses $orderby expression into a list of (field path, direction)
+
+    Args:
+        text    $orderby expression (e.g. user/name asc,total desc)
+    """
+    return _PARSER.parse(text)
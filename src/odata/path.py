@@ -1,4 +1,5 @@
 
+from functools import lru_cache
 from lark import Lark, Transformer, v_args
 # Full grammar for OData $filter with complex types
 
@@ -7,7 +8,7 @@ odata_path_grammar = r"""
 
 start: resource_path
 
-resource_path: "/" segment ("/" segment)* "/"?
+resource_path: "/" segment ("/" segment)*
 segment: dotted_name key_predicate?
 key_predicate: "(" key_values ")"
 key_values: key_value ("," key_value)* | value ("," value)*
@@ -68,4 +69,27 @@ class ODataPathTransformer(Transformer):
         return list(segments)
 
     def start(self,path):
-        return path
\ No newline at end of file
+        return path
+
+
+# Transformer is applied inline during LALR reductions, so no intermediate
+# Tree objects are built
+_TRANSFORMER = ODataPathTransformer()
+
+# The parser is built once per process; cache=True additionally stores the
+# LALR tables on disk so new processes skip the grammar analysis as well.
+# Terminals only use plain re syntax, so the stdlib re module is enough
+_PARSER = Lark(odata_path_grammar, parser='lalr', lexer='contextual', transformer=_TRANSFORMER, regex=False,
+               maybe_placeholders=False, propagate_positions=False, cache=True)
+
+# Clients tend to resend the same expressions (paging, polling), so parsed
+# results are memoized. Cached results are shared and must not be modified
+@lru_cache(maxsize=4096)
+def parse_path(text: str):
+    """Parses OData resource path into a list of segments
+
+    Args:
+        text    url path (e.g. /users(1)/orders)
+    """
+    # trailing slash is dropped here, which keeps the grammar free of optional tails
+    return _PARSER.parse(text.rstrip('/') or '/')
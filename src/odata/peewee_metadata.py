@@ -1,32 +1,48 @@
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import io
+from xml.sax.saxutils import escape
 from peewee import *
 from typing import Set, Optional, Union, List
 import inspect
+from functools import lru_cache
+
+def _attr(value) -> str:
+    """Escapes value of a double quoted XML attribute"""
+    return escape(str(value), {'"': '&quot;'})
+
+# Peewee field classes and their OData EDM types, subclasses come before their bases
+# (e.g. TimestampField is a BigIntegerField, AutoField an IntegerField)
+_EDM_TYPES = (
+    (TimestampField, 'Edm.DateTimeOffset'),
+    (BigAutoField, 'Edm.Int64'),
+    (BigIntegerField, 'Edm.Int64'),
+    (SmallIntegerField, 'Edm.Int16'),
+    (IntegerField, 'Edm.Int32'),
+    (FloatField, 'Edm.Double'),
+    (DecimalField, 'Edm.Decimal'),
+    (BooleanField, 'Edm.Boolean'),
+    (DateTimeField, 'Edm.DateTimeOffset'),
+    (DateField, 'Edm.Date'),
+    (TimeField, 'Edm.TimeOfDay'),
+    (UUIDField, 'Edm.Guid'),
+    (BinaryUUIDField, 'Edm.Guid'),
+    (BlobField, 'Edm.Binary'),
+    (CharField, 'Edm.String'),
+    (TextField, 'Edm.String'),
+    (ForeignKeyField, 'Edm.Int32'),  # Default, will be overridden by related field type
+)
+
+# Models use a small set of field classes, each one is matched once
+@lru_cache(maxsize=None)
+def _edm_type(field_class) -> str:
+    for peewee_class, edm_type in _EDM_TYPES:
+        if issubclass(field_class, peewee_class):
+            return edm_type
+    return 'Edm.String'
 
 class PeeweeODataMeta:
     def peewee_to_odata_type(field_type):
-        """Convert Peewee field types to OData EDM types."""
-        type_mapping = {
-            CharField: 'Edm.String',
-            TextField: 'Edm.String',
-            IntegerField: 'Edm.Int32',
-            BigIntegerField: 'Edm.Int64',
-            SmallIntegerField: 'Edm.Int16',
-            FloatField: 'Edm.Double',
-            DoubleField: 'Edm.Double',
-            DecimalField: 'Edm.Decimal',
-            BooleanField: 'Edm.Boolean',
-            DateField: 'Edm.Date',
-            DateTimeField: 'Edm.DateTimeOffset',
-            TimeField: 'Edm.TimeOfDay',
-            TimestampField: 'Edm.DateTimeOffset',
-            BlobField: 'Edm.Binary',
-            UUIDField: 'Edm.Guid',
-            ForeignKeyField: 'Edm.Int32',  # Default, will be overridden by related field type
-        }
-        
-        return type_mapping.get(type(field_type), 'Edm.String')
+        """Convert Peewee field types (including their subclasses) to OData EDM types."""
+        return _edm_type(type(field_type))
 
 
     def is_nullable_field(field):
@@ -41,38 +57,45 @@ class PeeweeODataMeta:
         return None
 
 
-    def find_backreferences(model_class, all_models=None):
+    def backreference_index(all_models):
         """
-        Find backreferences by examining foreign key relationships.
-        This is more reliable than relying on _meta.backrefs structure.
+        Index backreferences of all models at once: {referenced model: [backref, ...]}.
+        Every model is scanned once, instead of once per referenced model.
         """
-        backrefs = []
-        
-        if all_models is None:
-            # Try to get all models from the database registry
-            try:
-                all_models = list(model_class._meta.database._models.values())
-            except:
-                # If that fails, we can't find backrefs without explicit model list
-                return backrefs
-        
-        # Look through all models to find those that reference this model
+        index = {}
         for other_model in all_models:
-            if other_model == model_class:
-                continue
-                
             # Check each field in the other model
             for field_name, field_obj in other_model._meta.fields.items():
-                if isinstance(field_obj, ForeignKeyField) and field_obj.rel_model == model_class:
+                if isinstance(field_obj, ForeignKeyField):
                     # Found a backref - the field name becomes the collection name
                     backref_name = getattr(field_obj, 'backref', f"{other_model.__name__.lower()}s")
-                    backrefs.append({
+                    index.setdefault(field_obj.rel_model, []).append({
                         'name': backref_name,
                         'related_model': other_model,
                         'foreign_key_field': field_name
                     })
+        return index
+
+
+    def find_backreferences(model_class, all_models=None, index=None):
+        """
+        Find backreferences by examining foreign key relationships.
+        This is more reliable than relying on _meta.backrefs structure.
+
+        index (see backreference_index) can be given when backreferences of several models are needed.
+        """
+        if index is None:
+            if all_models is None:
+                # Try to get all models from the database registry
+                try:
+                    all_models = list(model_class._meta.database._models.values())
+                except:
+                    # If that fails, we can't find backrefs without explicit model list
+                    return []
+            index = PeeweeODataMeta.backreference_index(all_models)
         
-        return backrefs
+        # Models referencing this model (self references are not backrefs)
+        return [backref for backref in index.get(model_class, ()) if backref['related_model'] != model_class]
 
 
     # Example usage and helper function to create metadata for multiple models
@@ -86,6 +109,9 @@ class PeeweeODataMeta:
         """
         Create OData v4 metadata document for multiple Peewee model classes.
         
+        Documents are cached per arguments, models are expected not to change
+        their fields at runtime (see clear_metadata_cache otherwise).
+        
         Args:
             model_classes: List of Peewee model classes
             namespace: OData namespace
@@ -97,47 +123,48 @@ class PeeweeODataMeta:
         Returns:
             str: Formatted XML metadata document
         """
-        if field_configs is None:
-            field_configs = {}
-        
-        # Create root element
-        root = ET.Element('edmx:Edmx')
-        root.set('xmlns:edmx', 'http://docs.oasis-open.org/odata/ns/edmx')
-        root.set('Version', '4.0')
-        
-        # Create DataServices element
-        data_services = ET.SubElement(root, 'edmx:DataServices')
-        
-        # Create Schema element
-        schema = ET.SubElement(data_services, 'Schema')
-        schema.set('xmlns', 'http://docs.oasis-open.org/odata/ns/edm')
-        schema.set('Namespace', namespace)
-        
-        # Create EntityContainer
-        container = ET.SubElement(schema, 'EntityContainer')
-        container.set('Name', container_name)
+        try:
+            configs = tuple((model_name, tuple((key, tuple(value) if isinstance(value, list) else value)
+                                               for key, value in config.items()))
+                            for model_name, config in (field_configs or {}).items())
+            hash(configs)
+        except TypeError:
+            # configuration with unhashable values, document is generated every time
+            return PeeweeODataMeta._build_metadata(model_classes, namespace, container_name,
+                                                   field_configs or {}, include_navigation)
+        return _metadata_document(tuple(model_classes), namespace, container_name, configs, include_navigation)
+
+    def clear_metadata_cache():
+        """Drop cached metadata documents (e.g. after models were changed)"""
+        _metadata_document.cache_clear()
+
+    def _build_metadata(model_classes, namespace, container_name, field_configs, include_navigation):
+        """Generate metadata document, see create_multi_model_metadata"""
+        # Document has a fixed shape, elements are written as indented lines directly:
+        # entity sets of the container and entity types are collected while models are processed
+        entity_sets = []
+        entity_types = io.StringIO()
+        write = entity_types.write
         
+        # Backreferences of all models are collected in one pass
+        backref_index = PeeweeODataMeta.backreference_index(model_classes) if include_navigation else None
+
         # Process each model
         for model_class in model_classes:
             model_name = model_class.__name__
             config = field_configs.get(model_name, {})
             
-            # Create EntityType (reuse logic from single model function)
-            entity_type = ET.SubElement(schema, 'EntityType')
-            entity_type.set('Name', model_name)
+            # Child elements of the EntityType
+            entity_lines = []
             
-            # Find primary key
-            primary_key_field = None
-            for field_name, field_obj in model_class._meta.fields.items():
-                if field_obj.primary_key:
-                    primary_key_field = field_name
-                    break
+            # Primary key is known to peewee, composite keys (and no key) are not referenced
+            primary_key = model_class._meta.primary_key
+            primary_key_field = None if not primary_key or model_class._meta.composite_key else primary_key.name
             
             # Create Key element
             if primary_key_field:
-                key_element = ET.SubElement(entity_type, 'Key')
-                property_ref = ET.SubElement(key_element, 'PropertyRef')
-                property_ref.set('Name', primary_key_field)
+                entity_lines.append(
+                    f'        <Key>\n          <PropertyRef Name="{_attr(primary_key_field)}" />\n        </Key>\n')
             
             # Get field configuration
             allowed_fields = config.get('allowed_fields')
@@ -171,32 +198,29 @@ class PeeweeODataMeta:
                         navigation_properties.append(nav_prop)
                     
                     # Foreign key property
-                    fk_property = ET.SubElement(entity_type, 'Property')
-                    fk_property.set('Name', f"{field_name}Id")
-                    
                     related_pk_type = 'Edm.Int32'
                     if hasattr(field_obj.rel_model._meta, 'primary_key'):
                         related_pk_field = field_obj.rel_model._meta.primary_key
                         related_pk_type = PeeweeODataMeta.peewee_to_odata_type(related_pk_field)
                     
-                    fk_property.set('Type', related_pk_type)
-                    fk_property.set('Nullable', str(PeeweeODataMeta.is_nullable_field(field_obj)).lower())
+                    nullable = str(PeeweeODataMeta.is_nullable_field(field_obj)).lower()
+                    entity_lines.append(
+                        f'        <Property Name="{_attr(field_name)}Id" Type="{related_pk_type}" Nullable="{nullable}" />\n')
                 
                 else:
                     # Regular property
-                    property_elem = ET.SubElement(entity_type, 'Property')
-                    property_elem.set('Name', field_name)
-                    property_elem.set('Type', PeeweeODataMeta.peewee_to_odata_type(field_obj))
-                    property_elem.set('Nullable', str(PeeweeODataMeta.is_nullable_field(field_obj)).lower())
+                    odata_type = PeeweeODataMeta.peewee_to_odata_type(field_obj)
+                    nullable = str(PeeweeODataMeta.is_nullable_field(field_obj)).lower()
                     
                     max_length = PeeweeODataMeta.get_max_length(field_obj)
-                    if max_length:
-                        property_elem.set('MaxLength', max_length)
+                    max_length = f' MaxLength="{_attr(max_length)}"' if max_length else ''
+                    entity_lines.append(
+                        f'        <Property Name="{_attr(field_name)}" Type="{odata_type}" Nullable="{nullable}"{max_length} />\n')
             
             # Add backreference navigation properties - use more reliable method
             if include_navigation:
                 try:
-                    backrefs = PeeweeODataMeta.find_backreferences(model_class, model_classes)
+                    backrefs = PeeweeODataMeta.find_backreferences(model_class, model_classes, index=backref_index)
                     for backref in backrefs:
                         backref_name = backref['name']
                         
@@ -220,24 +244,42 @@ class PeeweeODataMeta:
             
             # Create navigation property elements
             for nav_prop in navigation_properties:
-                nav_element = ET.SubElement(entity_type, 'NavigationProperty')
-                nav_element.set('Name', nav_prop['name'])
-                nav_element.set('Type', nav_prop['type'])
-                if nav_prop['nullable']:
-                    nav_element.set('Nullable', 'true')
+                nullable = ' Nullable="true"' if nav_prop['nullable'] else ''
+                entity_lines.append(
+                    f'        <NavigationProperty Name="{_attr(nav_prop["name"])}" Type="{_attr(nav_prop["type"])}"{nullable} />\n')
+            
+            # Create EntityType
+            if entity_lines:
+                write(f'      <EntityType Name="{_attr(model_name)}">\n')
+                write(''.join(entity_lines))
+                write('      </EntityType>\n')
+            else:
+                write(f'      <EntityType Name="{_attr(model_name)}" />\n')
             
             # Create EntitySet
-            entity_set = ET.SubElement(container, 'EntitySet')
-            entity_set.set('Name', f"{model_name}s")
-            entity_set.set('EntityType', f"{namespace}.{model_name}")
+            entity_sets.append(
+                f'        <EntitySet Name="{_attr(model_name)}s" EntityType="{_attr(namespace)}.{_attr(model_name)}" />\n')
         
-        # Convert to pretty-printed string
-        rough_string = ET.tostring(root, encoding='unicode')
-        reparsed = minidom.parseString(rough_string)
-        pretty_xml = reparsed.toprettyxml(indent='  ')
+        if entity_sets:
+            container = f'      <EntityContainer Name="{_attr(container_name)}">\n{"".join(entity_sets)}      </EntityContainer>\n'
+        else:
+            container = f'      <EntityContainer Name="{_attr(container_name)}" />\n'
         
-        # Remove empty lines
-        lines = [line for line in pretty_xml.split('\n') if line.strip()]
-        return '\n'.join(lines)
+        return ('<?xml version="1.0" ?>\n'
+                '<edmx:Edmx xmlns:edmx="http://docs.oasis-open.org/odata/ns/edmx" Version="4.0">\n'
+                '  <edmx:DataServices>\n'
+                f'    <Schema xmlns="http://docs.oasis-open.org/odata/ns/edm" Namespace="{_attr(namespace)}">\n'
+                f'{container}{entity_types.getvalue()}'
+                '    </Schema>\n'
+                '  </edmx:DataServices>\n'
+                '</edmx:Edmx>')
 
 
+# Clients request $metadata whenever they (re)discover the service and the document
+# only depends on the arguments, generated documents are kept. Field configs are
+# passed as nested tuples to be hashable
+@lru_cache(maxsize=32)
+def _metadata_document(model_classes, namespace, container_name, field_configs, include_navigation):
+    field_configs = {model_name: dict(config) for model_name, config in field_configs}
+    return PeeweeODataMeta._build_metadata(model_classes, namespace, container_name,
+                                           field_configs, include_navigation)
@@ -1,19 +1,225 @@
+import copy
+import json
+import operator
+import re
+import sqlite3
+from collections import OrderedDict, deque
 from enum import Enum
-from functools import reduce
-from operator import and_
+from functools import lru_cache, partial, reduce
+from itertools import chain, count
+from operator import and_, or_
 from typing import List, Tuple
-from urllib.parse import parse_qs, quote, urlencode, urlparse, urlunparse
-from peewee import Model,ForeignKeyField,Field,DateField, DateTimeField
+from urllib.parse import quote
+from peewee import JOIN,Model,ModelSelect,ModelRaw,ForeignKeyField,Field,DateField, DateTimeField, Expression, OP, SQL, fn, SqliteDatabase, PostgresqlDatabase
 
-from odata.filter import ODataField, ODataFunction, ODataLogOperator, ODataOperator, ODataPrimitve
+from odata.filter import ODataField, ODataFunction, ODataLogOperator, ODataNotOperator, ODataOperator, ODataPrimitve
 from odata.odata_parser import ODataParser,ODataURLParser
 from logging import Logger
 from datetime import datetime
 from dateutil.parser import isoparse
 
+try:
+    import orjson
+except ImportError:  # optional, to_odata_json falls back to json
+    orjson = None
+
 class ODataQueryException(Exception):
     pass
 
+# Map OData operators and functions to their peewee expressions
+_OPERATOR_MAP = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "lt": operator.lt,
+    "ge": operator.ge,
+    "le": operator.le,
+
+    "add": operator.add,
+    "sub": operator.sub,
+    "mul": operator.mul,
+    "div": operator.truediv,
+    # % is LIKE for peewee columns, modulo has to be built explicitly
+    "mod": lambda a, b: Expression(a, OP.MOD, b),
+}
+
+_FUNCTION_MAP = {
+    "contains": lambda a1, a2: a1.contains(str(a2)),
+    "startswith": lambda a1, a2: a1.startswith(str(a2)),
+    "endswith": lambda a1, a2: a1.endswith(str(a2)),
+    "now" : lambda : datetime.now()
+}
+
+# Functions whose value changes between requests, their results must not be cached
+_VOLATILE_FUNCTIONS = frozenset(("now",))
+
+@lru_cache(maxsize=1024)
+def _is_volatile(node) -> bool:
+    """Checks if a parsed $filter expression calls a function whose value changes over time"""
+    node_type = type(node)
+    if node_type is ODataFunction:
+        return node.name in _VOLATILE_FUNCTIONS or any(map(_is_volatile, node.args))
+    if node_type is ODataLogOperator:
+        return any(map(_is_volatile, node.operands))
+    if node_type is ODataNotOperator:
+        return _is_volatile(node.expr)
+    if node_type is ODataOperator:
+        return _is_volatile(node.a) or _is_volatile(node.b)
+    return False
+
+# Alias of the window column with the total number of records for paging
+_TOTAL_ALIAS = "_odata_total"
+
+@lru_cache(maxsize=None)
+def _supports_window(database) -> bool:
+    """Checks if database supports window functions (COUNT(*) OVER())"""
+    if isinstance(database, SqliteDatabase):
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    return isinstance(database, PostgresqlDatabase)
+
+# Compiled SQL of already built queries {cache key: (sql, params, state)}, see
+# PeeweeODataQuery.set_query_cache. Bounded, least recently used entries are dropped
+_QUERY_CACHE = OrderedDict()
+_QUERY_CACHE_SIZE = 512
+
+# Compiled filters {(navigated class, filter shape): (expression builder, joined models)}
+_FILTER_CACHE = OrderedDict()
+_FILTER_CACHE_SIZE = 1024
+
+# Attributes set while building a query, restored on a cache hit
+_QUERY_STATE = ("navigated_class", "path_classes", "select_fields", "sorts", "where_cond", "joins",
+                "_joins_set", "complex_classes", "_window_total", "next_page")
+
+# $skiptoken parameter in the query string (the $ may come url encoded)
+_SKIPTOKEN_RE = re.compile(r'([?&])(?:\$|%24)skiptoken=[^&#]*')
+
+@lru_cache(maxsize=64)
+def _collection_map(models:tuple) -> dict:
+    """Maps collection names used in urls (e.g. users) to the model classes"""
+    return {model.__name__.lower()+"s": model for model in models}
+
+@lru_cache(maxsize=None)
+def _fk_fields(model) -> tuple:
+    """Foreign key fields of the model as (name, field) pairs"""
+    return tuple((field_name, field_object) for field_name, field_object in model._meta.fields.items()
+                 if isinstance(field_object, ForeignKeyField) and hasattr(field_object,'rel_model'))
+
+@lru_cache(maxsize=None)
+def _rel_index(model) -> dict:
+    """Relations of the model by name {name: (related class, data type, backref)}:
+    foreign key fields and backrefs of other models' foreign keys"""
+    index = {field.backref: (field.model, DataType.COLLECTION, True)
+             for field in model._meta.backrefs if not field.backref.startswith('+')}
+    index.update((name, (field.rel_model, DataType.FIELD, False)) for name, field in _fk_fields(model))
+    return index
+
+@lru_cache(maxsize=None)
+def _backref_fields(model) -> dict:
+    """Foreign keys of the model by their backref name {backref: (field, related model)}"""
+    return {field.backref: (field, rel_model)
+            for rel_model, fields in model._meta.model_refs.items() for field in fields}
+
+@lru_cache(maxsize=None)
+def _related(model, other) -> bool:
+    """Checks if one of the models has a foreign key to the other one"""
+    return (any(field.rel_model is other for _, field in _fk_fields(model))
+            or any(field.rel_model is model for _, field in _fk_fields(other)))
+
+def _join_on(model, other):
+    """Join condition of two models related by exactly one foreign key, None otherwise"""
+    fks = [field for _, field in _fk_fields(model) if field.rel_model is other]
+    fks.extend(field for _, field in _fk_fields(other) if field.rel_model is model)
+    if len(fks) != 1:
+        return None
+    return fks[0] == fks[0].rel_field
+
+def _noop(*args, **kwargs):
+    pass
+
+def _json_default(value):
+    """Encodes values json does not know (dates, decimals, ...)"""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+_json_dumps = partial(json.dumps, default=_json_default, separators=(",", ":"))
+
+def iter_json(response, dumps=None):
+    """Encodes OData response to JSON in chunks, a streamed "value" (see to_odata_response)
+    is consumed and encoded row by row
+
+    Args:
+        response    result of PeeweeODataQuery.to_odata_response
+        dumps       function encoding one value to str, json.dumps with dates as ISO strings by default
+    """
+    if dumps is None:
+        dumps = _json_dumps
+    if not isinstance(response, dict) or "value" not in response:
+        yield dumps(response)
+        return
+
+    yield '{"value":['
+    separator = ""
+    for row in response["value"]:
+        yield separator + dumps(row)
+        separator = ","
+    yield "]"
+    for key, value in response.items():
+        if key != "value":
+            yield "," + dumps(key) + ":" + dumps(value)
+    yield "}"
+
+def _flatten(name:str,operands):
+    """Yields operands of a logical operator, splicing in nested nodes of the same operator
+
+    Parser already merges such chains, this covers trees built by hand
+    """
+    for expr in operands:
+        if type(expr) == ODataLogOperator and expr.name == name:
+            yield from _flatten(name,expr.operands)
+        else:
+            yield expr
+
+# Comparisons of one field fused into a list test {logical operator: (comparison, field method)}
+_FUSED_COMPARISONS = {
+    "or": ("eq", "in_"),
+    "and": ("ne", "not_in"),
+}
+
+def _compared_value(expr, name:str):
+    """Returns (field, value) if expression compares a field with a (not null) value using operator name"""
+    if type(expr) != ODataOperator or expr.name != name:
+        return None
+    a, b = expr.a, expr.b
+    if type(a) == ODataPrimitve:
+        a, b = b, a
+    # null comparisons are IS (NOT) NULL, they cannot be in a list
+    if type(a) == ODataField and type(b) == ODataPrimitve and b.value is not None:
+        return a, b
+    return None
+
+# Placeholder of a filter value, filters differing only in values share one compiled builder
+_VALUE_SLOT = ODataPrimitve(...)
+
+def _filter_shape(node, values:list):
+    """Returns filter with (not null) values replaced by _VALUE_SLOT, values are appended
+    to the list in the order they are taken by the compiled filter"""
+    node_type = type(node)
+    if node_type == ODataPrimitve:
+        if node.value is None:
+            return node
+        values.append(node.value)
+        return _VALUE_SLOT
+    if node_type == ODataOperator:
+        return node._replace(a=_filter_shape(node.a, values), b=_filter_shape(node.b, values))
+    if node_type == ODataLogOperator:
+        return node._replace(operands=tuple(_filter_shape(expr, values) for expr in node.operands))
+    if node_type == ODataNotOperator:
+        return node._replace(expr=_filter_shape(node.expr, values))
+    if node_type == ODataFunction:
+        return node._replace(args=tuple(_filter_shape(arg, values) for arg in node.args))
+    return node
+
 class DataType(Enum):
     """Enumeration representing different types of OData elements in the system.
 
@@ -27,6 +233,9 @@ class DataType(Enum):
     FIELD = 3
 
 class NavigationPath:
+    # One instance per url segment, slots keep them small
+    __slots__ = ("cl_model", "where", "data_type", "path", "full_path", "via_backref", "backref_field", "ids", "key_where")
+
     def __init__(self,cl_model,path="",data_type=DataType.COLLECTION):
         self.cl_model = cl_model
         self.where = []
@@ -36,6 +245,8 @@ class NavigationPath:
         self.via_backref = False
         self.backref_field = None
         self.ids = []
+        # Key conditions only reference cl_model, they can be moved to its join
+        self.key_where = []
         
 
     def add_id_cond(self,keys:List[str],model_keys=[]):
@@ -81,6 +292,7 @@ class NavigationPath:
                 key_index = key_index + 1
 
                 self.where.append( cond )
+                self.key_where.append( cond )
 
     def join_backref(self,field1,field2):
         """Function adds field = key where condition for peewee instance, for the backrefs 
@@ -106,7 +318,13 @@ class PeeweeODataQuery:
         Relatioship orerations or functions are not yet implemented
 
     """
-    def __init__(self,models:list, url:str , expandable=[],logger:Logger = None,etag_callable=None,select_always=["id"]):
+    # Resolved filter/orderby/select fields {(navigated class, name): (field, joined models)},
+    # the joins are registered again when a cached field is used
+    _FIELD_CACHE = {}
+    # Classes reached by path prefixes {(navigated class, segments): (class, data type, backref, joined models)}
+    _PREFIX_CACHE = {}
+
+    def __init__(self,models:list, url:str , expandable=None,logger:Logger = None,etag_callable=None,select_always=None):
         """Constructor
 
         Args:
@@ -115,37 +333,49 @@ class PeeweeODataQuery:
             expandable          allowed peewee model clases to expand, but not to browse as root (no modification allowed)
             logger              logger to log operations
             etag_callable       object function to get etag (all models should have it implemented if given)
-            select_always       a list of fileds to select alwys like id or modification date/time, since they are needed for some specific manipulation before final output
+            select_always       a list of fileds to select alwys like id or modification date/time, since they are needed for some specific manipulation before final output (default ["id"])
         """
         self.models=models
         self.navigated_class = None
         self.logger = logger
+        if logger is None:
+            # no logger: skip the call entirely
+            self.write_log = _noop
         self.etag_callable = etag_callable
 
         #Parse Parameters
         self.url = url
-        self.parser = ODataParser(url)
-        self.parser.run()
+        self.parser = ODataParser.cached(url)
 
         self.parent = None
         self.select = []
-        self.select_fields = []
+        self.select_fields = {}
         self.joins = []
+        self._joins_set = set()
+        # Conditions added to the ON clause of inner joins {model: [conditions]}
+        self._join_conds = {}
         self.where_cond = []
         self.path_classes = None
-        self.expands = []
+        self.expands = {}
         self.expand_queries =  {}
+        # Set by the parent query for expand sub trees, collects their nested expand queries
+        self._prefetch_list = None
         self.sorts = []
-        self.select_always = select_always
+        # Defaults are created per instance, lists given by the caller are not changed
+        self.select_always = ["id"] if select_always is None else select_always
+
+        self.expandable = [] if expandable is None else expandable
 
-        # Add a cache for model relationships
-        self._model_rel_cache = {}
-        self.expandable = expandable
+        # Lookups for the url collection names and models allowed in paths
+        self._collection_map = _collection_map(tuple(models))
+        self._allowed_models = frozenset(models).union(self.expandable)
 
         #Forced pagination
         self.skiptoken_size = 0
         self.skiptoken_page = 0
         self.next_page = 0
+        #Total for paging is selected with the rows (COUNT(*) OVER())
+        self._window_total = False
 
         #Hidden fields
         self.hidden = []
@@ -157,6 +387,15 @@ class PeeweeODataQuery:
 
         #Search fiedls
         self.search_fields = []
+        #Search with one regex per field instead of LIKE (database must support REGEXP)
+        self.use_regex_search = False
+        #Full text search table (SQLite FTS5) searched instead of the fields
+        self.search_fts_table = None
+
+        #Reuse compiled SQL of the same url (see set_query_cache)
+        self.use_query_cache = False
+        #Update/delete with single statements returning the rows (see set_direct_mutations)
+        self.use_direct_mutations = False
 
         #model related restrictions
         self.restrictions = {}
@@ -271,37 +510,93 @@ class PeeweeODataQuery:
             fields        list of field names
         """
         self.search_fields  = model_fields
-    def write_log(self,message:str):
+    def set_regex_search(self,enabled:bool):
+        """Method to search $search string with a (case insensitive) regex instead of LIKE
+        For SQLite the database has to be created with regexp_function=True
+
+        Args:
+            enabled        use regex search
+        """
+        self.use_regex_search  = enabled
+    def set_fts_search(self,table:str):
+        """Method to match $search with an SQLite FTS5 table instead of scanning search fields
+        The table indexes the navigated model, its rowid being the primary key (e.g. created with
+        content='user', content_rowid='id'). Search string is matched as one phrase, with the
+        trigram tokenizer this finds substrings like LIKE does
+
+        Args:
+            table        FTS5 table name, None to search fields again
+        """
+        self.search_fts_table  = table
+    def set_query_cache(self,enabled:bool):
+        """Method to reuse compiled SQL for urls which were already queried with the same settings
+        On a hit query() skips building the peewee query and returns a raw query (ModelRaw) instead
+        of a ModelSelect, so it cannot be refined further (where, order_by, ...).
+        Queries with $expand, $count, restrictions, expanded foreign keys or a $filter calling now()
+        are never cached
+
+        Args:
+            enabled        use query cache
+        """
+        self.use_query_cache  = enabled
+    def set_direct_mutations(self,enabled:bool):
+        """Method to update/delete an entity with a single UPDATE/DELETE ... RETURNING statement
+        when the database supports it, instead of loading it and calling save()/delete_instance().
+        Overridden save()/delete_instance() methods, their signals and recursive deletes are skipped
+
+        Args:
+            enabled        use direct mutations
+        """
+        self.use_direct_mutations  = enabled
+    def _query_cache_key(self,where,join):
+        """Key of the query in the compiled SQL cache, None if query cannot be cached
+
+        Args:
+            where     extra where conditions passed to query()
+            join      extra joins passed to query()
+        """
+        if not self.use_query_cache or where or join or self.restrictions:
+            return None
+        return (self.url, tuple(self.models), tuple(self.expandable), tuple(self.select_always),
+                tuple(self.search_fields), self.use_regex_search, self.search_fts_table, self.skiptoken_size, self.expand_complex,
+                self.allow_query_filter, self.allow_query_select, self.allow_query_expand, self.allow_query_search,
+                tuple((name, tuple(keys)) for name, keys in self.model_keys.items()))
+    def write_log(self,message:str,*args):
         """Method to write logs if logger is provided
 
         Args:
-            message        message string
+            message        message string with %s placeholders
+            args           placeholder values, formatted by the logger only if the record is emitted
         """
         if self.logger:
-            self.logger.info(message)
+            self.logger.info(message,*args)
     
     def _include_search_fieds(self,model,search:str):
         """To be run right before request to add search  fields with AND operator
-        ([collected where conditions]) AND ([search fields contain $search])
+        ([collected where conditions]) AND ([any of search fields contains $search])
 
         Args:
             model       Peewee model
             search      search string
         """  
-        if not self.search_fields or search == None or search == "":
-            self.write_log(f"No fields to search, skipping")
+        if search == None or search == "":
+            self.write_log("No fields to search, skipping")
             return
-            
-        search_conds = []
-        for field in self.search_fields:
-            if field in model._meta.fields:
-                search_conds.append(getattr(model,field).contains(search))
-                self.write_log(f"Adding search in {model} {field} with {search}")
+
+        if self.search_fts_table:
+            # index lookup instead of a scan, quotes are doubled inside the FTS phrase
+            table = self.search_fts_table
+            phrase = '"' + search.replace('"', '""') + '"'
+            search_conds = [model._meta.primary_key.in_(
+                SQL(f'(SELECT rowid FROM "{table}" WHERE "{table}" MATCH ?)', (phrase,)))]
+            self.write_log("Adding full text search in %s with %s", table, search)
+        else:
+            search_conds = self._search_field_conds(model, search)
 
         if search_conds:
             base_cond = reduce(and_, self.where_cond) if self.where_cond else None
-            # Combine search conditions
-            search_cond = reduce(and_, search_conds)
+            # Combine search conditions, it is enough when one of the fields matches
+            search_cond = reduce(or_, search_conds)
 
             # Merge both with AND
             if base_cond:
@@ -311,6 +606,22 @@ class PeeweeODataQuery:
 
             self.where_cond = [final_cond]
 
+    def _search_field_conds(self,model,search:str):
+        """Conditions matching search string in each of the search fields of the model"""
+        fields = model._meta.fields
+        # inline flag keeps the match case insensitive like LIKE, SQLite has no IREGEXP
+        pattern = "(?i)" + re.escape(search) if self.use_regex_search else None
+
+        search_conds = []
+        for field in self.search_fields:
+            if field in fields:
+                if pattern is None:
+                    search_conds.append(fields[field].contains(search))
+                else:
+                    search_conds.append(fields[field].regexp(pattern))
+                self.write_log("Adding search in %s %s with %s", model, field, search)
+        return search_conds
+
     def add_restricition(self,model,where_conds=[]):
         """ Adds restrictive "where" conditions for the model
 
@@ -320,6 +631,45 @@ class PeeweeODataQuery:
         """             
         self.restrictions[model.__name__] = where_conds
 
+    def _add_join(self,model):
+        """ Registers model to be joined, each model is joined only once
+
+        Args:
+            model           model class to join
+        """
+        if model not in self._joins_set:
+            self._joins_set.add(model)
+            self.joins.append(model)
+
+    def _apply_joins(self,query):
+        """ Joins registered models, each one from the last joined model it is related to
+        (e.g. order/user from OrderItem joins Order from OrderItem and User from Order)
+
+        Args:
+            query           peewee select query of the navigated class
+        """
+        joined = [self.navigated_class]
+        pending = list(self.joins)
+        while pending:
+            for model in pending:
+                src = next((joined_model for joined_model in reversed(joined) if _related(joined_model, model)), None)
+                if src is not None:
+                    break
+            else:
+                # nothing is related, let peewee report it
+                src, model = self.navigated_class, pending[0]
+            conds = self._join_conds.get(model)
+            on = _join_on(src, model) if conds else None
+            if on is not None:
+                query = query.join_from(src, model, JOIN.INNER, on=reduce(and_, conds, on))
+            else:
+                query = query.join_from(src, model)
+                if conds:
+                    query = query.where(*conds)
+            joined.append(model)
+            pending.remove(model)
+        return query
+
     def query(self,where=[],join=[]):
         """ Execute Query (GET)
 
@@ -330,6 +680,21 @@ class PeeweeODataQuery:
             these are used for expand recusrive function processing
         """      
 
+        cache_key = self._query_cache_key(where,join)
+        if cache_key is not None:
+            cached = _QUERY_CACHE.get(cache_key)
+            if cached is not None:
+                try:
+                    _QUERY_CACHE.move_to_end(cache_key)
+                except KeyError:
+                    pass
+                sql, params, state, parser = cached
+                self.write_log("Query : reusing compiled SQL %s", sql)
+                for name, value in state.items():
+                    setattr(self, name, copy.copy(value))
+                self.parser = copy.copy(parser)
+                return self.navigated_class.raw(sql, *params)
+
         self.apply_navigation_model()
         
         #Apply implemented query options
@@ -349,47 +714,62 @@ class PeeweeODataQuery:
 
         #Apply select fields if exist
         if self.select_fields:
-            for mod_class,field in self.select_fields:
-                select.append(field)
-            self.write_log(f"Selecting fields {self.select}")
+            select.extend(self.select_fields.values())
+            self.write_log("Selecting fields %s", self.select)
         else:
             select.append(self.navigated_class)
+        select_set = set(select)
 
         #Collect all joins and conds 
+        path_conds = list(self.path_classes[-1].where)
         for item in self.path_classes[:-1]:
-            self.where_cond.extend(item.where)
-            self.joins.append(item.cl_model)
-
-
-        self.where_cond.extend(self.path_classes[-1].where) 
+            self._add_join(item.cl_model)
+            # Keys of the parent entities filter their join, the database can prune the rows
+            # before joining the next ones
+            if item.key_where:
+                self._join_conds[item.cl_model] = item.key_where
+                keys = set(map(id, item.key_where))
+                path_conds.extend(cond for cond in item.where if id(cond) not in keys)
+            else:
+                path_conds.extend(item.where)
 
-        self.where_cond.extend(where)
-        if self.navigated_class.__name__ in self.restrictions:
-            self.where_cond.extend(self.restrictions[self.navigated_class.__name__])
+        # Conditions are AND-ed into one expression here instead of by peewee for every where() argument
+        conds = list(chain(self.where_cond, path_conds, where,
+                           self.restrictions.get(self.navigated_class.__name__, ())))
+        self.where_cond = [reduce(and_, conds)] if conds else []
 
-        self.joins.extend(join)
+        for model in join:
+            self._add_join(model)
         
-        self.write_log(f"Query : sel {self.navigated_class} {select} join {self.joins} where {self.where_cond} with fetch {backrefs}")
+        self.write_log("Query : sel %s %s join %s where %s with fetch %s", self.navigated_class, select, self.joins, self.where_cond, backrefs)
         
         #Support for auto expanding FK definitions in the model
+        fields = self.navigated_class._meta.fields
         if self.expand_complex:
-            self.complex_classes = [field_name for field_name, field_object in self.navigated_class._meta.fields.items() ]
-
-        elif self.complex_classes:
-            #Expand properties with class relations passed as $expand  
-            fields_to_expand = [(field_name, field_object) for field_name, field_object in self.navigated_class._meta.fields.items() if field_name in self.complex_classes]
-            self.write_log(f"Adding complex expands :  {fields_to_expand}")
-            for field_name, field_object in fields_to_expand:
-                if isinstance(field_object, ForeignKeyField) and hasattr(field_object,'rel_model'):
-                    if field_object.rel_model not in select:
-                        select.append(field_object.rel_model)
-                    if field_object.rel_model not in self.joins:
-                        self.joins.append(field_object.rel_model)
+            self.complex_classes = list(fields)
+
+        if self.complex_classes:
+            #Expand properties with class relations (passed as $expand or all with expand_complex),
+            #related models are joined and selected so no query per row is needed.
+            #Each foreign key gets its own alias, so several keys to one model and
+            #keys to the model itself are joined on their own column
+            fk_pairs = [(field_name, field_object) for field_name, field_object in _fk_fields(self.navigated_class)
+                        if field_name in self.complex_classes]
+            self.write_log("Adding complex expands :  %s", fk_pairs)
+            fk_joins = []
+            for field_name, field_object in fk_pairs:
+                alias = field_object.rel_model.alias()
+                select.append(alias)
+                fk_joins.append((field_name, alias, field_object == getattr(alias, field_object.rel_field.name)))
+        else:
+            fk_joins = ()
 
         query = self.navigated_class.select(*select).distinct()
 
         if self.joins:
-            query = query.join(*self.joins)
+            query = self._apply_joins(query)
+        for field_name, alias, on in fk_joins:
+            query = query.join_from(self.navigated_class, alias, JOIN.LEFT_OUTER, on=on, attr=field_name)
         
         #Add search conditions if exist
         if self.allow_query_search:
@@ -404,23 +784,40 @@ class PeeweeODataQuery:
             query = query.order_by(*keys)
 
         if self.skiptoken_size != 0:
-            cnt_query = query
-            total = cnt_query.count()
-            if total > self.skiptoken_size:
+            model = self.navigated_class
+            # DISTINCT is applied after window functions, so the window total is
+            # only exact without joins and with the primary key in the selection.
+            # The page override below depends on the total only when the client
+            # sent its own $skip or a $top smaller than a page, so those windows
+            # keep count() and are left alone when everything fits in a page
+            client_window = bool(self.parser.skip) or (self.parser.top is not None
+                                                       and self.parser.top < self.skiptoken_size)
+            if (not client_window and not self.joins
+                    and (model in select_set or model._meta.primary_key in select_set)
+                    and _supports_window(model._meta.database)):
+                # Total is read from the fetched rows (see to_odata_response),
+                # which saves a separate COUNT query
+                query = query.select_extend(fn.COUNT(SQL('*')).over().alias(_TOTAL_ALIAS))
+                self._window_total = True
+                total = None
+            else:
+                total = query.count()
+
+            if total is None or total > self.skiptoken_size:
                 if self.parser.skip_token == None:
                     self.parser.skip_token = 0
                 self.parser.skip = self.parser.skip_token * self.skiptoken_size
                 
-                if self.parser.skip > total or ( self.parser.skip  + self.skiptoken_size) >= total:
-                    self.next_page = -1 
-                else:
-                    self.next_page = self.parser.skip_token + 1
+                if total is not None:
+                    self._set_next_page(total)
 
                 self.parser.top  =  self.skiptoken_size
                 
-                self.write_log(f"Skipping {self.parser.skip} records and limit to {self.parser.top} with skiptoken = {self.parser.skip_token}")
+                self.write_log("Skipping %s records and limit to %s with skiptoken = %s", self.parser.skip, self.parser.top, self.parser.skip_token)
+            else:
+                self.next_page = -1
 
-        if self.parser.count == True:
+        if self.parser.count:
             self.counted = query.count()
 
         if self.parser.skip is not None:
@@ -432,11 +829,23 @@ class PeeweeODataQuery:
 
 
         if self.expands:
-            expand_queries = []
-            self._build_expand_queries(self.navigated_class,expand_queries)
-            query = query.prefetch(*expand_queries)
-
-
+            if self._prefetch_list is None:
+                expand_queries = []
+                self._build_expand_queries(self.navigated_class,expand_queries)
+                query = query.prefetch(*expand_queries)
+            else:
+                # Sub tree of an expand: nested expands are prefetched together with the root query
+                self._build_expand_queries(self.navigated_class,self._prefetch_list)
+
+        # Paging totals from count() and prefetched or joined objects cannot be replayed from SQL
+        elif (cache_key is not None and not self.complex_classes and not self.parser.count
+                and (self.skiptoken_size == 0 or self._window_total)
+                and not (self.allow_query_filter and self.parser.filter is not None and _is_volatile(self.parser.filter))):
+            sql, params = query.sql()
+            _QUERY_CACHE[cache_key] = (sql, tuple(params), {name: copy.copy(getattr(self, name)) for name in _QUERY_STATE},
+                                       copy.copy(self.parser))
+            if len(_QUERY_CACHE) > _QUERY_CACHE_SIZE:
+                _QUERY_CACHE.popitem(last=False)
 
         return query
     def create(self,data={},rewrite_filed_values={},default_field_values={}):  
@@ -455,7 +864,7 @@ class PeeweeODataQuery:
             raise ODataQueryException(f"Operation is not supported") 
         
         #Query params cannot be applied to mutations
-        if self.parser.has_parameters():
+        if self.parser._has_params:
             raise ODataQueryException(f"Mutation does not support query parameters!")
         
         cur_navig = self.path_classes[-1]
@@ -469,7 +878,7 @@ class PeeweeODataQuery:
         #Checking backref
         if len(self.path_classes)>1 and self.path_classes[-2].data_type == DataType.ENTITY:
             prev_navig = self.path_classes[-2]
-            self.write_log(f"Setting backref : {cur_navig.backref_field.name} to {prev_navig.ids} ")
+            self.write_log("Setting backref : %s to %s ", cur_navig.backref_field.name, prev_navig.ids)
             data[cur_navig.backref_field.name] = prev_navig.ids[0]["value"]
 
 
@@ -500,7 +909,7 @@ class PeeweeODataQuery:
         if not self.allow_update:
             raise ODataQueryException(f"Operation is not supported") 
         
-        if self.parser.has_parameters():
+        if self.parser._has_params:
             raise ODataQueryException(f"Mutation does not support query parameters!")
         
         cur_navig = self.path_classes[-1]
@@ -511,24 +920,12 @@ class PeeweeODataQuery:
         if cur_navig.data_type != DataType.ENTITY:
             raise ODataQueryException(f"Can only update entities ,not collections!")
         
-        #First execute a query to get udpated record
-        res_data = list(self.query(where=where))
-
-        if not res_data:
-            raise ODataQueryException(f"Entiity does not exist")
-        if len(res_data) != 1:
-            raise ODataQueryException(f"Selection returned back more than one entity!")    
-        
-        entity = res_data[0]
-        
-        if "@odata.etag" in data and self.etag_callable:
-            f = getattr(entity,self.etag_callable)
-            etag = f()
-            if etag != data["@odata.etag"]:
-                raise ODataQueryException(f"Data was already modified old {data['@odata.etag']} vs new  {etag}!")
+        model = cur_navig.cl_model
+        # Etag has to be compared with the stored entity first
+        check_etag = "@odata.etag" in data and self.etag_callable
               
         # Remove primary key fields from data if present
-        pk_fields = entity._meta.primary_key.field_names if hasattr(entity._meta.primary_key, 'field_names') else [entity._meta.primary_key.name]
+        pk_fields = model._meta.primary_key.field_names if hasattr(model._meta.primary_key, 'field_names') else [model._meta.primary_key.name]
 
         for pk_field in pk_fields:
             if pk_field in data:
@@ -537,7 +934,7 @@ class PeeweeODataQuery:
 
         if len(self.path_classes)>1 and self.path_classes[-2].data_type == DataType.ENTITY:
             prev_navig = self.path_classes[-2]
-            self.write_log(f"Setting backref : {cur_navig.backref_field.name} to {prev_navig.ids} ")
+            self.write_log("Setting backref : %s to %s ", cur_navig.backref_field.name, prev_navig.ids)
             data[cur_navig.backref_field.name] = prev_navig.ids[0]["value"]
         
 
@@ -551,7 +948,8 @@ class PeeweeODataQuery:
                 data[key] = value
 
         #loop provided fields
-        for field_name, field_obj in entity._meta.fields.items():
+        values = {}
+        for field_name, field_obj in model._meta.fields.items():
                 if field_obj.primary_key :
                     continue
                 if field_name not in data:
@@ -559,8 +957,22 @@ class PeeweeODataQuery:
                         raise ODataQueryException("Field {field_name} was not provided, use patch to modify specific fields!")
                     else:
                         continue 
-                setattr(entity, field_name,data[field_name])
-        
+                values[field_name] = data[field_name]
+
+        if values and not check_etag and self._mutate_directly(model):
+            return self._execute_returning(model, model.update(values), where)
+
+        #Execute a query to get udpated record
+        entity = self._get_single_entity(where)
+
+        if check_etag:
+            f = getattr(entity,self.etag_callable)
+            etag = f()
+            if etag != data["@odata.etag"]:
+                raise ODataQueryException(f"Data was already modified old {data['@odata.etag']} vs new  {etag}!")
+
+        for field_name, value in values.items():
+            setattr(entity, field_name,value)
 
         entity.save()
 
@@ -577,7 +989,7 @@ class PeeweeODataQuery:
         if not self.allow_delete:
             raise ODataQueryException(f"Operation is not supported") 
            
-        if self.parser.has_parameters():
+        if self.parser._has_params:
             raise ODataQueryException(f"Mutation does not support query parameters!")
         
         cur_navig = self.path_classes[-1]
@@ -588,18 +1000,82 @@ class PeeweeODataQuery:
         if cur_navig.data_type != DataType.ENTITY:
             raise ODataQueryException(f"Can only update entities ,not collections!")
         
-        res_data = list(self.query(where=where))
+        model = cur_navig.cl_model
+        if self._mutate_directly(model):
+            return self._execute_returning(model, model.delete(), where)
+
+        entity = self._get_single_entity(where)
+
+        entity.delete_instance()
+
+        return entity
+
+    def _get_single_entity(self,where=[]):
+        """ Queries the entity to modify
+
+        Args:
+            where   "where" restricition conditions
+        """  
+        model = self.navigated_class
+        if len(self.path_classes) == 1:
+            # Entity addressed by its own keys: no joins, filters or expands to build,
+            # two rows are enough to detect an ambiguous key
+            query = model.select().where(reduce(and_, self._mutation_conds(model, where)))
+            res_data = list(query.limit(2))
+        else:
+            query = self.query(where=where)
+            if isinstance(query, ModelSelect):
+                # more rows are not needed to detect an ambiguous path
+                query = query.limit(2)
+            res_data = list(query)
 
         if not res_data:
             raise ODataQueryException(f"Entiity does not exist")
         if len(res_data) != 1:
             raise ODataQueryException(f"Selection returned back more than one entity!")    
         
-        entity = res_data[0]
+        return res_data[0]
 
-        entity.delete_instance()
+    def _mutate_directly(self,model) -> bool:
+        """ Checks if entity can be modified with a single UPDATE/DELETE ... RETURNING statement:
+        direct mutations are enabled, entity is addressed by its own keys (no navigation joins)
+        and database returns modified rows
 
-        return entity
+        Args:
+            model   navigated model class
+        """  
+        return self.use_direct_mutations and len(self.path_classes) == 1 and model._meta.database.returning_clause
+
+    def _mutation_conds(self,model,where=[]) -> list:
+        """ Conditions selecting the entity addressed by a single segment path
+
+        Args:
+            model   navigated model class
+            where   "where" restricition conditions
+        """  
+        return list(chain(self.path_classes[-1].where, where, self.restrictions.get(model.__name__, ())))
+
+    def _execute_returning(self,model,query,where=[]):
+        """ Executes UPDATE/DELETE of the navigated entity and returns the modified entity
+
+        Args:
+            model   navigated model class
+            query   peewee update or delete query
+            where   "where" restricition conditions
+        """  
+        conds = self._mutation_conds(model, where)
+        self.write_log("Mutation : %s where %s", model, conds)
+
+        with model._meta.database.atomic():
+            res_data = list(query.where(reduce(and_, conds)).returning(model).execute())
+
+            if not res_data:
+                raise ODataQueryException(f"Entiity does not exist")
+            # Raising inside the transaction rolls the statement back
+            if len(res_data) != 1:
+                raise ODataQueryException(f"Selection returned back more than one entity!")    
+
+        return res_data[0]
     
     def _expression_to_string(self,expr):
         """ Peewee expression to string
@@ -626,11 +1102,7 @@ class PeeweeODataQuery:
 
 
         """   
-        for model, fields in referred_model._meta.model_refs.items():
-            for field in fields:
-                if field.backref == backref_name:
-                    return field,model
-        return None,None
+        return _backref_fields(referred_model).get(backref_name, (None,None))
 
     def _convert_str_to_dateandtime(self,s:str)-> datetime:
         """ Converts ODATA datetime str to datetime object
@@ -658,188 +1130,237 @@ class PeeweeODataQuery:
             data    ODataField with field name
 
         """   
-        return self._resolve_field_name(field.name)
+        return self._resolve_field_name(field.name, field.path)
 
-    def _resolve_field_name(self,data:str):
+    def _resolve_field_name(self,data:str,segs:tuple=None):
         """ Resolves field names (eg order/date)
 
         Args:
             data    field name in relation to currently processed navigated class
+            segs    name already split into path segments (optional)
 
         """   
         
-        self.write_log("Resolving name {data}")
+        self.write_log("Resolving name %s", data)
 
         cur_class = self.navigated_class
-        cache_key = (cur_class, data)
-         # Use cached relationships if available
-        if data in self._model_rel_cache:
-            res_cl,res_dt,_ = self._model_rel_cache[cache_key]
-            if res_dt != DataType.FIELD:
-                raise ODataQueryException(f"Referenced fieled is Entity or collection, not a field {data}")
-            return res_cl
+        # Use cached field if it was already resolved, models on the path still have to be allowed
+        field_key = (cur_class, data)
+        cached = self._FIELD_CACHE.get(field_key)
+        if cached is not None and self._allowed_models.issuperset(cached[1]):
+            field, joined = cached
+            for model in joined:
+                self._add_join(model)
+            return field
         
         fld = data
+        joined = ()
         
         data_type = DataType.ENTITY
 
         #Logic for subfields and backrefs
-        if '/' in data:
+        if not segs:
             segs = data.split('/')
+        if len(segs) > 1:
             fld = segs[-1]
+            # Sibling fields (e.g. user/name, user/email) share their path prefix, it is walked once
+            prefix_key = (cur_class, tuple(segs[:-1]))
+            cached = self._PREFIX_CACHE.get(prefix_key)
+            if cached is not None and self._allowed_models.issuperset(cached[3]):
+                cur_class, data_type, backref, joined = cached
+                for model in joined:
+                    self._add_join(model)
+                segs = ()
             for seg in segs[:-1]:
                 rel_class , data_type , backref= self.find_model_rel(cur_class,seg)
                 if not rel_class:
-                    self.write_log(f"No name {seg}")
+                    self.write_log("No name %s", seg)
                     raise ODataQueryException(f"Unknown field {seg}") 
                 
                 #allow only defined models
-                if rel_class not in self.models and rel_class not in self.expandable:
+                if rel_class not in self._allowed_models:
                     raise ODataQueryException("Path or attribute does not exist")
                 
-                self.write_log(f"Resolved class for the field ref {rel_class}")
+                self.write_log("Resolved class for the field ref %s", rel_class)
                 cur_class = rel_class
 
                 #add class to the collection
                 #if rel_class not in self.select:
                 #    self.select.append(rel_class)
 
-                if rel_class not in self.joins:
-                    self.joins.append(rel_class)
-                
+                self._add_join(rel_class)
+                joined += (rel_class,)
+
+            if segs:
+                self._PREFIX_CACHE[prefix_key] = (cur_class, data_type, backref, joined)
 
         if data_type == DataType.COLLECTION and backref==False:
             raise ODataQueryException(f"Relation was resolved instead of entity for field {seg}") 
         
-        if fld not in cur_class._meta.fields:
+        field = cur_class._meta.fields.get(fld)
+        if field is None:
            raise ODataQueryException(f"Cannot find field {fld} in object {cur_class}") 
-
-        field = getattr(cur_class,fld)
         
         # Cache the resolved field
-        cache_key = (cur_class, data)
-        self._model_rel_cache[cache_key] = (field,DataType.FIELD,False)
+        self._FIELD_CACHE[field_key] = (field, joined)
 
         return field
     
-    def _resolve_value(self,data):
-        if type(data) == ODataPrimitve:
-            return data.value
-        raise ODataQueryException("Cannot detect type of {data}")
-    
-    def _filter_run_expression(self,expression):
-        """ Resolves OData expression recieved from parser (see Odata parser)
+    def _resolve_fields(self,names:List[str]) -> List[Field]:
+        """ Resolves several field names at once, repeated names and shared
+        path prefixes are resolved only once
+
+        Args:
+            names    field names in relation to currently processed navigated class
+
+        """
+        resolved = {name: self._resolve_field_name(name) for name in dict.fromkeys(names)}
+        return [resolved[name] for name in names]
+
+    def _compile_expression(self,expression):
+        """ Compiles OData expression recieved from parser (see Odata parser) into a function
+        building the peewee expression from the filter values (see _filter_shape)
+
+        Args:
+            expression    OData expressiion with value placeholders
+
+        """ 
+        compiler = self._EXPRESSION_COMPILERS.get(type(expression))
+        if compiler is None:
+            raise ODataQueryException(f"Unknown expression {expression} ")   
+        return compiler(self,expression)
+
+    def _compile_not_expression(self,expression):
+        """ Compiles OData NOT expression
 
         Args:
             expression    OData expressiion
 
         """ 
-        #get first logical expression
-        if type(expression) == ODataLogOperator:
-            return self._filter_apply_log_expressions(expression)
+        self.write_log("Applying filter expression %s", expression.name)
+        build = self._compile_expression(expression.expr)
+        return lambda values: ~build(values)
 
-        
+    def _compile_value(self,data):
+        """ Compiles OData value, placeholders take the next filter value
 
-        # Use a dictionary to map operators to their corresponding functions
-        operator_map = {
-            "eq": lambda f, v: f == v,
-            "ne": lambda f, v: f != v,
-            "gt": lambda f, v: f > v,
-            "lt": lambda f, v: f < v,
-            "ge": lambda f, v: f >= v,
-            "le": lambda f, v: f <= v,
-
-
-            "add": lambda a, b: a + b,
-            "sub": lambda a, b: a - b,
-            "mul": lambda a, b: a * a,
-            "div": lambda a, b: a / b,
-
-        }
-
-        function_map = {
-            "contains": lambda a1, a2: a1.contains(str(a2)),
-            "startswith": lambda a1, a2: a1.startswith(str(a2)),
-            "endswith": lambda a1, a2: a1.endswith(str(a2)),
-            "now" : lambda : datetime.now()
-        }
-        
-        #function or comparison?
-        if type(expression) == ODataOperator:
-            self.write_log(f"Applying operator: {expression.name} with {expression.a},{expression.b}")
-
-            if type(expression.a) == ODataPrimitve:
-                a =  self._resolve_value(expression.a)
-            elif type(expression.a) == ODataField:
-                a =self._resolve_field(expression.a)
-            else:
-                a =self._filter_run_expression(expression.a)
+        Args:
+            data    ODataPrimitve
 
-            if type(expression.b) == ODataPrimitve:
-                b =  self._resolve_value(expression.b)
-            elif type(expression.b) == ODataField:
-                b =self._resolve_field(expression.b)
-            else:
-                b =self._filter_run_expression(expression.b)
+        """ 
+        if type(data) != ODataPrimitve:
+            raise ODataQueryException(f"Cannot detect type of {data}")
+        if data is _VALUE_SLOT:
+            index = next(self._filter_slots)
+            return lambda values: values[index]
+        value = data.value
+        return lambda values: value
 
-            op = expression.name    
-            
-            _is_a_dt = (isinstance(a, DateField) or isinstance(a, DateTimeField))
-            _is_b_dt = (isinstance(b, DateField) or isinstance(b, DateTimeField))
-            
-            if _is_a_dt and type(b) == ODataPrimitve :
-                b = self._convert_str_to_dateandtime(b)
+    def _compile_operand(self,operand):
+        """ Compiles operand of OData comparison (value, field or nested expression)
 
-            if _is_b_dt and type(a) == ODataPrimitve :
-                a = self._convert_str_to_dateandtime(a)
+        Args:
+            operand    OData expressiion
 
-            if op in operator_map:
-                return operator_map[op](a, b)
-            
-        elif type(expression) == ODataFunction:
-            func = expression.name
-            args = expression.args
-            self.write_log(f"Applying function: { func }")
+        """ 
+        if type(operand) == ODataPrimitve:
+            return self._compile_value(operand)
+        if type(operand) == ODataField:
+            field = self._resolve_field(operand)
+            return lambda values: field
+        return self._compile_expression(operand)
+
+    def _compile_operator_expression(self,expression):
+        """ Compiles OData comparison and arithmetic operators
+
+        Args:
+            expression    OData expressiion
+
+        """ 
+        self.write_log("Applying operator: %s with %s,%s", expression.name, expression.a, expression.b)
+
+        op = _OPERATOR_MAP.get(expression.name)
+        if op is None:
+            raise ODataQueryException(f"Unknown expression {expression} ")   
+
+        a = self._compile_operand(expression.a)
+        b = self._compile_operand(expression.b)
+        return lambda values: op(a(values), b(values))
+
+    def _compile_function_expression(self,expression):
+        """ Compiles OData functions
+
+        Args:
+            expression    OData expressiion
+
+        """ 
+        name = expression.name
+        args = expression.args
+        self.write_log("Applying function: %s", name)
+
+        func = _FUNCTION_MAP.get(name)
+        if len(args) == 0 and func is not None:
+            # evaluated for every query (now)
+            return lambda values: func()
             
-            if len(args) == 0:
-                if func in function_map: 
-                    return function_map[func]()
-                
-            if len(args) != 2:
-                raise ODataQueryException(f"Function param error {func}") 
-            arg1 = self._resolve_field(args[0]) 
-            arg2 = self._resolve_value(args[1])   
-
-            if func in function_map:
-                return function_map[func](arg1, arg2)      
-               
-        raise ODataQueryException(f"Unknown expression {expression} ")   
+        if len(args) != 2:
+            raise ODataQueryException(f"Function param error {name}") 
+        if func is None:
+            raise ODataQueryException(f"Unknown expression {expression} ")   
+
+        field = self._resolve_field(args[0]) 
+        arg = self._compile_value(args[1])   
+        return lambda values: func(field, arg(values))
     
-    def _filter_apply_log_expressions(self,logoperator):
-        """ Applies expresions for the logical operators AND and OR
+    def _compile_log_expression(self,logoperator):
+        """ Compiles expresions for the logical operators AND and OR
 
         Args:
             expression    OData expressiion
 
         """ 
-        self.write_log(f"Applying filter expression { logoperator.name }")
-
-        if logoperator.name  == "not":
-            right_expr = logoperator.right
-            right_expr_res = self._filter_run_expression(right_expr)
-        else:
-            left_expr = logoperator.left
-            left_expr_res = self._filter_run_expression(left_expr)            
-            right_expr = logoperator.right
-            right_expr_res = self._filter_run_expression(right_expr)
+        self.write_log("Applying filter expression %s", logoperator.name)
 
         if logoperator.name == "and":
-            return (left_expr_res & right_expr_res)
+            join_op = and_
         elif logoperator.name == "or":
-            return (left_expr_res | right_expr_res)
-        elif logoperator.name == "not":
-            return ~(right_expr_res)
-        raise ODataQueryException(f"Unknown logical operator {logoperator.name}")
+            join_op = or_
+        else:
+            raise ODataQueryException(f"Unknown logical operator {logoperator.name}")
+
+        # Same field compared with several values (a eq 1 or a eq 2, a ne 1 and a ne 2)
+        # is one IN / NOT IN test, field is resolved once
+        comparison, method = _FUSED_COMPARISONS[logoperator.name]
+        operands = []
+        fused = {}
+        for expr in _flatten(logoperator.name,logoperator.operands):
+            compared = _compared_value(expr, comparison)
+            if compared is None:
+                operands.append(self._compile_expression(expr))
+            elif compared[0] in fused:
+                fused[compared[0]][1].append(self._compile_value(compared[1]))
+            else:
+                fused[compared[0]] = (len(operands), [self._compile_value(compared[1])])
+                operands.append(None)
+
+        for field, (index, args) in fused.items():
+            field = self._resolve_field(field)
+            if len(args) == 1:
+                op = _OPERATOR_MAP[comparison]
+                operands[index] = lambda values, field=field, arg=args[0]: op(field, arg(values))
+            else:
+                test = getattr(field, method)
+                operands[index] = lambda values, test=test, args=args: test([arg(values) for arg in args])
+
+        return lambda values: reduce(join_op, [build(values) for build in operands])
+
+    # Compilers of peewee expression builders by the type of the parsed filter node
+    _EXPRESSION_COMPILERS = {
+        ODataLogOperator: _compile_log_expression,
+        ODataNotOperator: _compile_not_expression,
+        ODataOperator: _compile_operator_expression,
+        ODataFunction: _compile_function_expression,
+    }
 
     def apply_select_model(self):
         """ Applies $select parameter
@@ -849,15 +1370,13 @@ class PeeweeODataQuery:
 
         """ 
         if self.parser.select: 
-            total_sel = []
-            total_sel.extend(self.parser.select)
-            total_sel.extend(self.select_always)
-
-            for field in total_sel:
+            model = self.navigated_class
+            fields = model._meta.fields
+            for field in chain(self.parser.select, self.select_always):
                 
-                if field in self.navigated_class._meta.fields and field not in self.select_fields:
-                    self.write_log(f"Adding selection field {field}")
-                    self.select_fields.append((self.navigated_class,getattr(self.navigated_class,field)))
+                if field in fields and (model, field) not in self.select_fields:
+                    self.write_log("Adding selection field %s", field)
+                    self.select_fields[(model, field)] = fields[field]
 
     def apply_sorting_model(self):
         """ Applies $orderby parameter
@@ -867,9 +1386,10 @@ class PeeweeODataQuery:
 
         """ 
         if self.parser.orderby:
-            self.write_log(f"Applying sorting  { self.parser.orderby }")
-            for field_name, direction in self.parser.orderby.items():
-                field = self._resolve_field_name(field_name)
+            self.write_log("Applying sorting  %s", self.parser.orderby)
+            orderby = self.parser.orderby
+            fields = self._resolve_fields([name for name, _ in orderby])
+            for field, (_, direction) in zip(fields, orderby):
                 self.sorts.append(field.desc() if direction == 'desc' else field.asc())
 
     def apply_filter_model(self):
@@ -884,18 +1404,31 @@ class PeeweeODataQuery:
         
         odata_filter = self.parser.filter
         
-        self.write_log(f"Applying filter {self.parser.filter.name}")
+        self.write_log("Applying filter %s", self.parser.filter.name)
         if odata_filter:
-            #fk = next(iter(odata_filter))
-            expr = None
-            if type(odata_filter) == ODataLogOperator:
-                expr = self._filter_apply_log_expressions(odata_filter)
-            elif type(odata_filter) == ODataFunction or type(odata_filter) == ODataOperator:
-                expr = self._filter_run_expression(odata_filter)
-            else:
+            if type(odata_filter) not in self._EXPRESSION_COMPILERS:
                 raise ODataQueryException(f"Wrong expression type in filter {odata_filter}")
+
+            # Filter is compiled once per model and shape (e.g. id eq 1 and id eq 2 share it),
+            # the compiled builder only creates the peewee expression for the values,
+            # joins the fields need are registered again
+            values = []
+            shape = _filter_shape(odata_filter, values)
+            cache_key = (self.navigated_class, shape)
+            cached = _FILTER_CACHE.get(cache_key)
+            if cached is not None and self._allowed_models.issuperset(cached[1]):
+                build, joined = cached
+                for model in joined:
+                    self._add_join(model)
+            else:
+                joins_before = len(self.joins)
+                self._filter_slots = count()
+                build = self._compile_expression(shape)
+                _FILTER_CACHE[cache_key] = (build, tuple(self.joins[joins_before:]))
+                if len(_FILTER_CACHE) > _FILTER_CACHE_SIZE:
+                    _FILTER_CACHE.popitem(last=False)
             
-            self.where_cond.append(expr)
+            self.where_cond.append(build(values))
 
 
 
@@ -908,7 +1441,7 @@ class PeeweeODataQuery:
         """ 
         start_seg = self.parser.parsed_path[0]["entity"]
 
-        ini_class = next((item for item in self.models if item.__name__.lower()+"s" == start_seg ),None)
+        ini_class = self._collection_map.get(start_seg)
 
         if not ini_class:
             raise ODataQueryException(f"Object collection {start_seg} does not exist or not defined") 
@@ -918,10 +1451,11 @@ class PeeweeODataQuery:
         ini_path = NavigationPath(ini_class,path=start_seg)
     
         if "keys" in self.parser.parsed_path[0]:
-            self.write_log(f"Applying keys path: { self.parser.parsed_path[0]['keys'] }")
+            self.write_log("Applying keys path: %s", self.parser.parsed_path[0]['keys'])
             ini_path.add_id_cond(self.parser.parsed_path[0]["keys"],self.model_keys[ini_class.__name__])
 
         self.path_classes.append(ini_path)
+        visited = {ini_class}
 
 
         for item in self.parser.parsed_path[1:]:
@@ -930,23 +1464,22 @@ class PeeweeODataQuery:
             #discover foreignkey or backref
             found_class, data_type, backref = self.find_model_rel(self.navigated_class,item["entity"])
             
-            self.write_log(f"Searching path: { item['entity'] }")
+            self.write_log("Searching path: %s", item['entity'])
             if found_class != None:
                 if self.path_classes[-1].data_type == DataType.COLLECTION and data_type == DataType.COLLECTION:
                     raise ODataQueryException(f"Incorrect path , two collections cannot be realted {self.path_classes[-1].path} and {item['entity']}")
                 
-                self.write_log(f"Checking if class {found_class} is allowed ")
+                self.write_log("Checking if class %s is allowed ", found_class)
 
-                if found_class not in self.models and found_class not in self.expandable:
+                if found_class not in self._allowed_models:
                     raise ODataQueryException(f"Operations is not allowed!")
                 
-                self.write_log(f"Found path: { item['entity'] }")
+                self.write_log("Found path: %s", item['entity'])
                 
-                pclass = next((item.cl_model for item in self.path_classes if item.cl_model == found_class ),None)
-
                 #avoid circular referencing
-                if pclass != None:
+                if found_class in visited:
                     raise ODataQueryException(f"Circular relation was discoverd in path {self.parser.path} , involving {self.navigated_class}")
+                visited.add(found_class)
                 
                 #Add navigation path to the collection
                 ref_class = NavigationPath(found_class,path=item["entity"],data_type=data_type)
@@ -960,7 +1493,7 @@ class PeeweeODataQuery:
                 
                 # if key provided in the Odata path apply it
                 if "keys" in item and item["keys"]:
-                    self.write_log(f"Adding keys: { item['keys'] }")
+                    self.write_log("Adding keys: %s", item['keys'])
                     ref_class.add_id_cond(item["keys"],self.model_keys[found_class.__name__])
                     data_type = DataType.ENTITY
 
@@ -970,8 +1503,9 @@ class PeeweeODataQuery:
             self.path_classes.append(ref_class)
             self.navigated_class = found_class
 
-            for item in self.path_classes:
-                self.write_log(f"Dicsovering path...{item.cl_model} {item.where} ")
+        if self.logger:
+            for pc in self.path_classes:
+                self.write_log("Dicsovering path...%s %s ", pc.cl_model, pc.where)
             
 
     def apply_expand_model(self,starting_class:Model):
@@ -986,13 +1520,13 @@ class PeeweeODataQuery:
                 exp_class, data_type,backref = self.find_model_rel(starting_class,item)
                 if exp_class:
 
-                    if exp_class not in self.models and exp_class not in self.expandable:
+                    if exp_class not in self._allowed_models:
                         raise ODataQueryException(f"Operation (expand) is not allowed!")
                     if backref:
                         if item not in self.expands:
-                            self.write_log(f"Adding expand {item} {nested}")
+                            self.write_log("Adding expand %s %s", item, nested)
                             #add expand parameter for later processing
-                            self.expands.append((exp_class,item,nested))
+                            self.expands[item] = (exp_class,item,nested)
                     else:
                         if item not in self.complex_classes:
                             self.complex_classes.append(item)
@@ -1006,35 +1540,25 @@ class PeeweeODataQuery:
             name           field name
 
         """ 
-        cache_key = (model_class, name)
-        if cache_key in self._model_rel_cache:
-            self.write_log(f"Resolved relation via cache: { name } from { model_class } value {self._model_rel_cache[cache_key]}")
-            return self._model_rel_cache[cache_key]
-        
-        # Detect foreign key fields
-        for field_name, field_object in model_class._meta.fields.items():
-            if field_name == name and isinstance(field_object, ForeignKeyField):
-                self._model_rel_cache[cache_key] = (field_object.rel_model,DataType.FIELD,False)
-                self.write_log(f"Resolved relation via model field: { name } from { model_class }")
-                return self._model_rel_cache[cache_key] 
-
-
-        # Detect backrefs by checking for ReverseRelationDescriptor type name
+        rel = _rel_index(model_class).get(name)
+        if rel is None:
+            self.write_log("Cannot find: %s from %s", name, model_class)
+            return  None , None , None
 
-        if hasattr(model_class,name):
-            attr = getattr(model_class, name)
-            self.write_log(f"Listing backref: { name } from { type(attr).__name__  }")
-            if type(attr).__name__ == 'BackrefAccessor':
-                related_model = getattr(attr, 'rel_model', None)
-                self._model_rel_cache[cache_key] = (related_model,DataType.COLLECTION,True)
-                self.write_log(f"Resolved relation via model backref: { name } from { model_class }")
-                return self._model_rel_cache[cache_key]
+        self.write_log("Resolved relation: %s from %s value %s", name, model_class, rel)
+        return rel
 
-        self.write_log(f"Cannot find: { name } from { model_class }")
-        self._model_rel_cache[cache_key] = (None,None,None)
 
-        return  None , None , None
+    def _set_next_page(self,total:int):
+        """ Sets next skiptoken page or -1 if the current page is the last one
 
+        Args:
+            total    total number of records
+        """ 
+        if total is None or ( self.parser.skip  + self.skiptoken_size) >= total:
+            self.next_page = -1 
+        else:
+            self.next_page = self.parser.skip_token + 1
 
     def _replace_skiptoken(self,new_token: str) -> str:
         """ Replaces skiptoken in url
@@ -1043,31 +1567,16 @@ class PeeweeODataQuery:
             new_token    new pagination token
 
         """ 
-        # Parse the URL into components
-        parsed_url = urlparse(self.url)
-        
-        # Parse the query string into a dictionary
-        query_params = parse_qs(parsed_url.query, keep_blank_values=True)
-        
-        # Replace or add the $skiptoken parameter
-        query_params['$skiptoken'] = [new_token]
-        
-        # Reconstruct the query string
-        new_query = urlencode(query_params, doseq=True, quote_via=quote)
-
+        # Only the token is replaced, the rest of the url is kept as it was sent
+        url, sep, fragment = self.url.partition('#')
+        token = quote(str(new_token))
 
+        if _SKIPTOKEN_RE.search(url):
+            url = _SKIPTOKEN_RE.sub(lambda m: m.group(1) + "$skiptoken=" + token, url, count=1)
+        else:
+            url += ('&' if '?' in url else '?') + "$skiptoken=" + token
 
-        # Rebuild the full URL
-        updated_url = urlunparse((
-            parsed_url.scheme,
-            parsed_url.netloc,
-            parsed_url.path,
-            parsed_url.params,
-            new_query,
-            parsed_url.fragment
-        ))
-        
-        return updated_url
+        return url + sep + fragment
 
 
     def _build_expand_queries(self,model,query_list=[]):
@@ -1078,12 +1587,12 @@ class PeeweeODataQuery:
             query_list  List of queries to add for prefetch
 
         """ 
-        for model,exp,nested in self.expands:
+        for model,exp,nested in self.expands.values():
 
             if self.max_expand == 0:
                 raise ODataQueryException("Maximum expand levels were reached!")
             
-            self.write_log(f"Expanding {exp} {nested} ")
+            self.write_log("Expanding %s %s ", exp, nested)
 
             child_include_etag = self.include_etag
             child_etag_callable = self.etag_callable
@@ -1127,94 +1636,207 @@ class PeeweeODataQuery:
             sub_tree.restrictions = self.restrictions
             sub_tree.with_odata_id = child_with_odata_id
 
-            filtered_query = sub_tree.query()
-            query_list.append(filtered_query)
+            # prefetch needs every query after the one it relates to
+            nested_queries = []
+            sub_tree._prefetch_list = nested_queries
+            query_list.append(sub_tree.query())
+            query_list.extend(nested_queries)
             self.expand_queries[exp] = sub_tree
 
 
-    def to_odata_response(self, query_result)-> list | dict:
-        """ Converts query result to a dictionary or list od dicts
+    def _dict_rows(self) -> bool:
+        """ Checks if query results can be serialized from dicts instead of model instances:
+        no etags (model method), no prefetched expands and no expanded foreign keys
 
-        Args:
-            query_result    model class to loop for backrefs and foreignkeys to check
+        """ 
+        return not (self.include_etag or self.expands or self.complex_classes)
+
+    def _row_serializer(self):
+        """ Builds function converting one row (model instance or dict) to a dict,
+        backrefs to expand get empty lists which are filled by _serialize_rows
 
         """ 
+        # Same for every row: expanded foreign keys and collection name for @odata.id
+        fk_names = [field_name for field_name, field_object in _fk_fields(self.navigated_class)
+                    if field_name in self.complex_classes] if self.complex_classes else ()
+        # None when the id is not added to the response
+        odata_prefix = self.navigated_class.__name__.lower() + "s(" if self.with_odata_id else None
+        etag_callable = self.etag_callable if self.include_etag else None
+        expands = list(self.expands)
+        # Removed fields: hidden ones and the ones which are always selected but not
+        # in the $select list (like id), expanded backrefs are added after the latter
+        mask = set(self.select_always).difference(self.parser.select, expands) if self.parser.select else set()
+        mask.update(self.hidden)
+        # Model data is copied only if the row dict is changed (a model has no paging total in __data__)
+        copy_data = bool(fk_names or odata_prefix is not None or etag_callable is not None or mask or expands)
+        mask.add(_TOTAL_ALIAS)
+
         def serialize(obj):
-            #Internal function for recursive processing            
-            data = obj.__data__.copy()
-
-
-            if self.complex_classes:
-                fields_to_expand = [(field_name, field_object) for field_name, field_object in self.navigated_class._meta.fields.items() if field_name in self.complex_classes]
-                for field_name, field_object in fields_to_expand:
-                    if isinstance(field_object, ForeignKeyField):
-                            try:
-                                related_obj = getattr(obj, field_name, None)
-                                if related_obj:
-                                    data[field_name] = related_obj.__data__.copy()
-                            except:
-                                pass                
-
-            if self.with_odata_id:
-                name = self.navigated_class.__name__.lower()+"s"
-                data["@odata.id"] = f"{name}({data['id']})"
-            if self.include_etag:
-                f = getattr(obj,self.etag_callable)
+            # rows read with dicts() are fresh dicts already
+            if type(obj) is dict:
+                data = obj
+            else:
+                data = obj.__data__.copy() if copy_data else obj.__data__
+
+            for field_name in fk_names:
+                try:
+                    related_obj = getattr(obj, field_name, None)
+                    if related_obj:
+                        data[field_name] = related_obj.__data__.copy()
+                except:
+                    pass                
+
+            if odata_prefix is not None:
+                data["@odata.id"] = odata_prefix + str(data['id']) + ")"
+            if etag_callable is not None:
+                f = getattr(obj,etag_callable)
                 data["@odata.etag"] = f()
 
-            
-            if self.parser.select:
-                #Hide fiedls which should be always selected but not in the list, like id 
-                
-                difference = [item for item in self.select_always if item not in self.parser.select]
-                 
-
-                data = {
-                    k: v
-                    for k, v in data.items()
-                    if k not in difference
-                }
-            
-            difference = None
-
-            for model, exp, nested in self.expands:
-                #    Check if the prefetched data exists on the object instance.
-                #    Peewee adds it as an attribute with the same name as the backref.
-                if hasattr(obj, exp):
-                    prefetched_results = getattr(obj, exp)
-                    sub_tree = self.expand_queries[exp] 
-                    data[exp] = [sub_tree.to_odata_response(item) for item in prefetched_results]
-                else:
-                    # If for some reason the data isn't there, return an empty list.
-                    data[exp] = []
-
-            # Hide fields:
-            data = {
-                k: v
-                for k, v in data.items()
-                if k not in self.hidden
-            }
 
+            for exp in expands:
+                data[exp] = []
 
+            for k in mask.intersection(data):
+                del data[k]
 
             return data
 
+        return serialize
+
+    def _serialize_rows(self, rows) -> list:
+        """ Converts rows to a list of dicts. Expanded backrefs are processed level by level
+        (breadth first): rows of one expand from all parents are converted in one batch
+
+        Args:
+            rows    model instances or dicts (query result or prefetched backref)
+
+        """ 
+        result = []
+        # (query tree, [(rows, list to fill)])
+        queue = deque([(self, [(rows, result)])])
+        while queue:
+            tree, batches = queue.popleft()
+            serialize = tree._row_serializer()
+            children = {exp: [] for exp in tree.expands}
+
+            for rows, out in batches:
+                for obj in rows:
+                    data = serialize(obj)
+                    out.append(data)
+                    for exp, batch in children.items():
+                        # Peewee adds prefetched data as an attribute with the same name as the backref
+                        if exp in data:
+                            batch.append((getattr(obj, exp, ()), data[exp]))
+
+            for exp, batch in children.items():
+                if batch:
+                    queue.append((tree.expand_queries[exp], batch))
+
+        return result
+
+    def _set_next_page_from_row(self,row):
+        """ Sets next skiptoken page from the window total selected with the rows
+
+        Args:
+            row    first row of the result (model instance or dict), None if result is empty
+        """ 
+        self._set_next_page(row.get(_TOTAL_ALIAS) if type(row) is dict else getattr(row, _TOTAL_ALIAS, None))
+
+    def _iter_serialized(self, rows):
+        """ Yields serialized rows one by one
+
+        Args:
+            rows    iterator of model instances or dicts
+        """ 
+        if self.expands:
+            for obj in rows:
+                yield self._serialize_rows((obj,))[0]
+        else:
+            serialize = self._row_serializer()
+            for obj in rows:
+                yield serialize(obj)
+
+    def to_odata_json(self, query_result) -> bytes:
+        """ Converts query result directly to JSON (bytes), rows are streamed from the query
+        and encoded one by one. Uses orjson if it is installed, json otherwise
+
+        Args:
+            query_result    query result, same as for to_odata_response
 
+        """ 
+        response = self.to_odata_response(query_result, stream=True)
+        if orjson is None:
+            return "".join(iter_json(response)).encode()
+
+        dumps = orjson.dumps
+        if not isinstance(response, dict) or "value" not in response:
+            return dumps(response, default=_json_default)
+
+        out = bytearray(b'{"value":[')
+        separator = b""
+        for row in response["value"]:
+            out += separator
+            out += dumps(row, default=_json_default)
+            separator = b","
+        out += b"]"
+        for key, value in response.items():
+            if key != "value":
+                out += b"," + dumps(key) + b":" + dumps(value, default=_json_default)
+        out += b"}"
+        return bytes(out)
+
+    def to_odata_response(self, query_result, stream:bool=False)-> list | dict:
+        """ Converts query result to a dictionary or list od dicts
+
+        Args:
+            query_result    model class to loop for backrefs and foreignkeys to check
+            stream          "value" is a generator, rows are fetched (query iterator) and serialized
+                            while it is consumed, instead of holding the whole result in memory
+
+        """ 
         if isinstance(query_result, Model):
-            result_list = [serialize(query_result)]
-        else:            
-            result_list = [serialize(obj) for obj in query_result]
+            query_result = [query_result]
+        elif isinstance(query_result, (ModelSelect, ModelRaw)) and query_result._cursor_wrapper is None:
+            if self._dict_rows():
+                # Nothing needs model instances, rows are read as plain dicts
+                query_result = query_result.dicts()
+            if stream:
+                # iterator() does not cache fetched rows in the query
+                query_result = query_result.iterator()
+
+        if stream:
+            rows = iter(query_result)
+            first = next(rows, None)
+            if self._window_total:
+                self._set_next_page_from_row(first)
+            if first is not None:
+                # up to two rows are read ahead: a single entity has the same shape as without streaming
+                second = next(rows, None)
+                if second is None:
+                    if self.counted is None:
+                        return self._serialize_rows((first,))[0]
+                    rows = iter((first,))
+                else:
+                    rows = chain((first, second), rows)
+            final_res = { "value" : self._iter_serialized(rows)}
+        else:
+            query_result = list(query_result)
 
+            if self._window_total:
+                self._set_next_page_from_row(query_result[0] if query_result else None)
+
+            result_list = self._serialize_rows(query_result)
+
+            # A single entity is returned as is, unless the count was requested with it
+            if len(result_list) == 1 and self.counted is None:
+                return result_list[0]
 
-        if len(result_list) == 1:
-            return result_list[0]
-        
-        if type(result_list) == list:
             final_res = { "value" : result_list}
-            if self.skiptoken_size != 0 and self.next_page != -1:
-                final_res["@odata.nextLink"] = self._replace_skiptoken(str(self.next_page))
 
-        if self.counted:
+        if self.skiptoken_size != 0 and self.next_page != -1:
+            final_res["@odata.nextLink"] = self._replace_skiptoken(str(self.next_page))
+
+        if self.counted is not None:
             final_res["@odata.count"] = self.counted
 
         return final_res
@@ -0,0 +1,15 @@
+import pytest
+from lark import Lark
+from odata.filter import ODataFilterTransformer, odata_filter_grammar
+
+# Shared pytest fixtures go here. The package is imported from the installed
+# project (pip install -e ."[test]") and markers are declared in pyproject.toml
+
+@pytest.fixture(scope="session")
+def filter_parser():
+    """Plain Lark parser of the $filter grammar, built once per test session.
+
+    The transformer is stateless; cache=True loads the LALR tables from Lark's
+    cache in the temp directory on later runs
+    """
+    return Lark(odata_filter_grammar, parser='lalr', transformer=ODataFilterTransformer(), cache=True)
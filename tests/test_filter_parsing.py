@@ -1,14 +1,18 @@
+import sys
 import pytest
 from lark import Lark
-from odata.filter import ODataFilterTransformer, ODataFunction, odata_filter_grammar
+from lark.exceptions import LarkError, UnexpectedCharacters
+from odata.filter import ODataFunction, ODataNotOperator, odata_filter_grammar, parse_filter, _ODataFilterParser
+from odata.orderby import odata_orderby_grammar
+from odata.path import odata_path_grammar
 
 class TestFilterParsing:
     """Test OData filter parsing functionality in isolation"""
     
     @pytest.fixture
-    def parser(self):
-        """Create filter parser instance"""
-        return Lark(odata_filter_grammar, parser='lalr', transformer=ODataFilterTransformer())
+    def parser(self, filter_parser):
+        """Filter parser instance (shared by the session, see conftest)"""
+        return filter_parser
     
     def test_simple_eq_filter(self, parser):
         """Test simple equality filter"""
@@ -18,20 +22,26 @@ class TestFilterParsing:
         assert result.name == "eq"
         assert result.b.value == "John"
     
-    def test_numeric_comparison(self, parser):
+    @pytest.mark.parametrize("filter_expr,expected_op,expected_value", [
+        ("age gt 25", "gt", 25),
+        ("price lt 100.5", "lt", 100.5),
+        ("count ge 10", "ge", 10),
+        ("rating le 4.5", "le", 4.5),
+        ("id ne 0", "ne", 0),
+    ])
+    def test_numeric_comparison(self, parser, filter_expr, expected_op, expected_value):
         """Test numeric comparisons"""
-        test_cases = [
-            ("age gt 25", "gt", 25.0),
-            ("price lt 100.5", "lt", 100.5),
-            ("count ge 10", "ge", 10.0),
-            ("rating le 4.5", "le", 4.5),
-            ("id ne 0", "ne", 0.0)
-        ]
-        
-        for filter_expr, expected_op, expected_value in test_cases:
-            result = parser.parse(filter_expr)
-            assert result.name == expected_op
-            assert result.b.value == expected_value
+        result = parser.parse(filter_expr)
+        assert result.name == expected_op
+        assert result.b.value == expected_value
+        assert type(result.b.value) == type(expected_value)
+
+    def test_integer_literals(self, parser):
+        """Test integer literals are kept as int"""
+        assert type(parser.parse("id eq 42").b.value) == int
+        assert type(parser.parse("id eq -7").b.value) == int
+        assert type(parser.parse("price eq 1.5").b.value) == float
+        assert type(parser.parse("price eq 1e3").b.value) == float
     
     def test_boolean_values(self, parser):
         """Test boolean value parsing"""
@@ -48,17 +58,13 @@ class TestFilterParsing:
     
     def test_string_functions(self, parser):
         """Test string functions"""
-        test_cases = [
-            "contains(name,'John')",
-            "startswith(email,'admin')",
-            "endswith(filename,'.pdf')"
-        ]
+        result = parser.parse("contains(name,'John') or startswith(email,'admin') or endswith(filename,'.pdf')")
         
-        for filter_expr in test_cases:
-            result = parser.parse(filter_expr)
-            assert type(result) == ODataFunction
-            assert result.args
-            assert len(result.args) == 2
+        assert result.name == "or"
+        assert [function.name for function in result.operands] == ["contains", "startswith", "endswith"]
+        for function in result.operands:
+            assert type(function) == ODataFunction
+            assert len(function.args) == 2
     
     def test_and_expression(self, parser):
         """Test AND logical expression"""
@@ -66,14 +72,13 @@ class TestFilterParsing:
         
         assert result.name == "and"
 
-        first = result.left
+        first, second = result.operands
         # First condition
         assert first.a.a.value == 9 
         assert first.name == "gt"
         assert first.b.name == "age"
         
         # Second condition
-        second = result.right
         assert second.a.name == "is_active"
         assert second.name == "eq"
         assert second.b.value is True
@@ -83,16 +88,17 @@ class TestFilterParsing:
         result = parser.parse("status eq 'active' or status eq 'pending'")
         
         assert result.name == "or"
-        assert result.left.name == "eq"
-        assert result.right.name == "eq"
+        assert result.operands[0].name == "eq"
+        assert result.operands[1].name == "eq"
         
     
     def test_not_expression(self, parser):
         """Test NOT logical expression"""
         result = parser.parse("not is_deleted eq true")
         
+        assert type(result) == ODataNotOperator
         assert result.name == "not"
-        inner = result.right
+        inner = result.expr
         assert inner.a.name == "is_deleted"
         assert inner.name == "eq"
         assert inner.b.value is True
@@ -104,11 +110,11 @@ class TestFilterParsing:
         assert result.name == "or"
         
         # Left side should be an AND expression
-        left = result.left.name
+        left = result.operands[0].name
         assert "and" == left
         
         # Right side should be simple comparison
-        right = result.right.a.name
+        right = result.operands[1].a.name
         assert right == "is_vip"
     
     def test_path_expressions(self, parser):
@@ -116,6 +122,7 @@ class TestFilterParsing:
         result = parser.parse("user/name eq 'John'")
         
         assert result.a.name == "user/name"
+        assert result.a.path == ("user", "name")
         assert result.name == "eq"
         assert result.b.value == "John"
     
@@ -132,6 +139,11 @@ class TestFilterParsing:
         
         assert result.a.name == "description"
         assert result.b.value == 'Product with "quotes"'
+
+    def test_double_quoted_non_ascii(self, parser):
+        """Test double-quoted strings keep non-ASCII text"""
+        assert parser.parse('name eq "Café"').b.value == "Café"
+        assert parser.parse('name eq "Café \\"Noir\\""').b.value == 'Café "Noir"'
     
     def test_function_with_multiple_args(self, parser):
         """Test functions with multiple arguments"""
@@ -151,20 +163,90 @@ class TestFilterParsing:
         
         assert result.name == "or"
         # The AND should be on the right side due to precedence
-        right_side = result.right
+        right_side = result.operands[1]
         assert right_side.name == "and"
+
+    def test_chained_log_operators(self, parser):
+        """Test chains of the same logical operator are merged into one node"""
+        result = parser.parse("a eq 1 and b eq 2 and (c eq 3 and d eq 4)")
+
+        assert result.name == "and"
+        assert [op.a.name for op in result.operands] == ["a", "b", "c", "d"]
+
+        result = parser.parse("a eq 1 or b eq 2 and c eq 3 or d eq 4")
+        assert result.name == "or"
+        assert len(result.operands) == 3
+        assert result.operands[1].name == "and"
     def test_complex(self,parser):
         """Test complex filter"""
         result = parser.parse("not(contains(Person/email,'x')) and ( created_at gt '2025-08-01T10:10:57' or startswith(name,'hello') )")
 
     def test_errors(self,parser):
-        """Test complex filter"""
-        error = False
-        try:
-            result = parser.parse("not(contains(Person/email,'x')) and ( created_at gt eq '2025-08-01T10:10:57' or startswith(name,'hello') )")
-        except:
-            error = True
-        assert error == True
+        """Test invalid complex filter is rejected by the grammar"""
+        with pytest.raises(LarkError):
+            parser.parse("not(contains(Person/email,'x')) and ( created_at gt eq '2025-08-01T10:10:57' or startswith(name,'hello') )")
+
+    def test_interned_operator_names(self, parser):
+        """Test operator names of the nodes are interned strings, shared by all parses"""
+        for result in (parser.parse("a eq 1 and not b ne 2"), parse_filter("a eq 1 and not b ne 2")):
+            assert result.name is sys.intern("and")
+            assert result.operands[0].name is sys.intern("eq")
+            assert result.operands[1].name is sys.intern("not")
+            assert result.operands[1].expr.name is sys.intern("ne")
+
+    @pytest.mark.parametrize("grammar", [odata_filter_grammar, odata_path_grammar, odata_orderby_grammar],
+                             ids=["filter", "path", "orderby"])
+    def test_grammar_strict(self, grammar):
+        """Test grammars stay conflict free LALR(1) without terminal collisions in the contextual lexer"""
+        # strict mode checks regex collisions with interegular
+        pytest.importorskip("interegular")
+        Lark(grammar, parser='lalr', lexer='contextual', strict=True)
+
+    def test_hand_parser_matches_grammar(self, parser):
+        """Test hand written parser builds the same trees as the Lark grammar"""
+        test_cases = [
+            "name eq 'John O''Brian'",
+            'description eq "Product with \\"quotes\\""',
+            "age gt -25 and price le 1.5e2 or id eq +3",
+            "not is_deleted eq true and deleted_at eq null",
+            "(9 add 9) gt age and a eq b eq c",
+            "contains(tolower(user/name),'jo') or startswith(email, \"admin\")",
+            "not(contains(Person/email,'x')) and ( created_at gt '2025-08-01T10:10:57' or startswith(name,'hello') )",
+            "concat(first,last) eq 'ab' and now() gt created and notes ne 'x'",
+        ]
+
+        for filter_expr in test_cases:
+            assert _ODataFilterParser(filter_expr).parse() == parser.parse(filter_expr)
+
+    def test_parse_filter(self):
+        """Test parse_filter falls back to the grammar and reports its errors"""
+        assert parse_filter("user/daylight eq 1").a.path == ("user", "daylight")
+        # keyword used as a field name is left to the grammar
+        assert parse_filter("and eq 1").a.name == "and"
+
+        with pytest.raises(LarkError):
+            parse_filter("created_at gt eq '2025-08-01T10:10:57'")
+
+    @pytest.mark.parametrize("filter_expr", ["year eq 2020", "contains eq 1", "year/month eq 1"])
+    def test_function_name_as_field(self, parser, filter_expr):
+        """Test function names without arguments are rejected by both parsers"""
+        with pytest.raises(LarkError):
+            parser.parse(filter_expr)
+        with pytest.raises(LarkError):
+            parse_filter(filter_expr)
+
+    def test_field_starting_with_function_name(self, parser):
+        """Test fields only starting with a function name are fields for both parsers"""
+        for filter_expr in ("daylight eq 1", "nowhere eq 1", "yearly eq 1", "user/year eq 1"):
+            assert parser.parse(filter_expr) == _ODataFilterParser(filter_expr).parse()
+
+    def test_parse_filter_invalid_characters(self):
+        """Test characters outside of string literals are rejected at the same position as by the grammar"""
+        assert parse_filter("name eq 'a;b*'").b.value == "a;b*"
+
+        with pytest.raises(UnexpectedCharacters) as exc:
+            parse_filter("name eq 'it''s' ; drop")
+        assert (exc.value.line, exc.value.column) == (1, 17)
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
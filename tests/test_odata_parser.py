@@ -1,19 +1,29 @@
+import json
+import re
+import sqlite3
 import pytest
 import tempfile
 import os
 from datetime import datetime, date
 from peewee import *
+from peewee import ModelRaw
 from unittest.mock import Mock
 
 from odata.filter import ODataLogOperator, ODataOperator
 
 # Assuming your package structure - adjust imports as needed
-from odata.odata_parser import ODataParser
-from odata.peewee_qodata import PeeweeODataQuery, ODataQueryException
+from odata.odata_parser import ODataParser, ODataURLParser
+from odata import peewee_qodata
+from odata.peewee_qodata import PeeweeODataQuery, ODataQueryException, iter_json
 from odata.peewee_metadata import PeeweeODataMeta
 
-# Test database setup
-test_db = SqliteDatabase(':memory:')
+# Test database setup, nothing has to survive a crash: no journal file syncing
+test_db = SqliteDatabase(':memory:', regexp_function=True, pragmas={
+    'journal_mode': 'memory',
+    'synchronous': 0,
+    'temp_store': 'memory',
+    'cache_size': -8000,
+})
 
 # Test models
 class User(Model):
@@ -59,51 +69,77 @@ class OrderItem(Model):
     class Meta:
         database = test_db
 
+# Models exposed by the tested services
+MODELS = (User, Order, Product, OrderItem)
+
+def _fts5_trigram_available() -> bool:
+    """Checks if SQLite supports FTS5 tables with the trigram tokenizer (3.34+, FTS5 compiled in)"""
+    if sqlite3.sqlite_version_info < (3, 34, 0):
+        return False
+    connection = sqlite3.connect(":memory:")
+    try:
+        connection.execute('CREATE VIRTUAL TABLE fts_check USING fts5(text, tokenize="trigram")')
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+    return True
+
+def _frozen_datetime(moment):
+    """datetime class whose now() returns the given moment"""
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return moment
+    return FrozenDatetime
+
 @pytest.fixture(scope="session", autouse=True)
 def setup_database():
     """Setup test database and create tables"""
     test_db.connect()
     test_db.create_tables([User, Order, Product, OrderItem])
     
-    # Create test data
-    user1 = User.create(
-        name="John Doe", 
-        email="john@example.com", 
-        age=30,
-        birth_date=date(1993, 5, 15)
-    )
-    user2 = User.create(
-        name="Jane Smith", 
-        email="jane@example.com", 
-        age=25,
-        birth_date=date(1998, 8, 22)
-    )
-    user3 = User.create(
-        name="Bob Wilson", 
-        email="bob@example.com", 
-        age=35,
-        is_active=False,
-        birth_date=date(1988, 12, 3)
-    )
-    
-    product1 = Product.create(name="Laptop", price=999.99, category="Electronics")
-    product2 = Product.create(name="Mouse", price=29.99, category="Electronics")
-    product3 = Product.create(name="Keyboard", price=79.99, category="Electronics", in_stock=False)
-    
-    order1 = Order.create(user=user1, total=1099.98, description="First order")
-    order2 = Order.create(user=user1, total=79.99, description="Second order", is_shipped=True)
-    order3 = Order.create(user=user2, total=29.99, description="Jane's order")
-    
-    OrderItem.create(order=order1, product=product1, quantity=1, unit_price=999.99)
-    OrderItem.create(order=order1, product=product2, quantity=1, unit_price=29.99)
-    OrderItem.create(order=order2, product=product3, quantity=1, unit_price=79.99)
-    OrderItem.create(order=order3, product=product2, quantity=1, unit_price=29.99)
+    # Create test data, one batch per table (ids are given, rows reference them)
+    with test_db.atomic():
+        User.insert_many([
+            {"id": 1, "name": "John Doe", "email": "john@example.com", "age": 30,
+             "is_active": True, "birth_date": date(1993, 5, 15)},
+            {"id": 2, "name": "Jane Smith", "email": "jane@example.com", "age": 25,
+             "is_active": True, "birth_date": date(1998, 8, 22)},
+            {"id": 3, "name": "Bob Wilson", "email": "bob@example.com", "age": 35,
+             "is_active": False, "birth_date": date(1988, 12, 3)},
+        ]).execute()
+
+        Product.insert_many([
+            {"id": 1, "name": "Laptop", "price": 999.99, "category": "Electronics", "in_stock": True},
+            {"id": 2, "name": "Mouse", "price": 29.99, "category": "Electronics", "in_stock": True},
+            {"id": 3, "name": "Keyboard", "price": 79.99, "category": "Electronics", "in_stock": False},
+        ]).execute()
+
+        Order.insert_many([
+            {"id": 1, "user": 1, "total": 1099.98, "description": "First order", "is_shipped": False},
+            {"id": 2, "user": 1, "total": 79.99, "description": "Second order", "is_shipped": True},
+            {"id": 3, "user": 2, "total": 29.99, "description": "Jane's order", "is_shipped": False},
+        ]).execute()
+
+        OrderItem.insert_many([
+            {"order": 1, "product": 1, "quantity": 1, "unit_price": 999.99},
+            {"order": 1, "product": 2, "quantity": 1, "unit_price": 29.99},
+            {"order": 2, "product": 3, "quantity": 1, "unit_price": 79.99},
+            {"order": 3, "product": 2, "quantity": 1, "unit_price": 29.99},
+        ]).execute()
     
     yield
     
-    test_db.drop_tables([User, Order, Product, OrderItem])
+    # referencing tables first, all DDL in one script
+    test_db.connection().executescript("".join(
+        f'DROP TABLE "{model._meta.table_name}";' for model in (OrderItem, Order, Product, User)))
     test_db.close()
 
+# Request combining most parameters, parsed once when the module is loaded
+_COMPLEX_PARSER = ODataParser("http://localhost/api/?$filter=users/id gt 7&$expand=users($select=id,email;$filter=not(contains(email,'x')) and created_at gt '2025-08-01T10:10:57';$orderby=id desc)&$top=1&$skip=0")
+_COMPLEX_PARSER.run()
+
 class TestODataURLParser:
     """Test OData URL parsing functionality"""
     
@@ -172,7 +208,25 @@ class TestODataURLParser:
         assert parser.filter is not None
         assert type(parser.filter) == ODataLogOperator
 
+
+    def test_cached_parsing(self):
+        """Test cached parser shares parsed structures but not scalar values"""
+        url = "http://localhost/api/users?$filter=age gt 25&$top=5"
+        first = ODataParser.cached(url)
+        first.top = 10
+        second = ODataParser.cached(url)
+
+        assert first is not second
+        assert second.top == 5
+        assert second.filter is first.filter
     
+    def test_smart_split(self):
+        """Test splitting ignores splitters inside parentheses and quotes"""
+        text = "orders($select=id,total), name eq 'a,b' ,items,\"x\\\",y\", ,last"
+        assert ODataURLParser.smart_split(text, ',') == [
+            "orders($select=id,total)", "name eq 'a,b'", "items", "\"x\\\",y\"", "last"]
+        assert ODataURLParser.smart_split("$top=1&$filter=name eq 'a&b'&", '&') == ["$top=1", "$filter=name eq 'a&b'"]
+
     def test_select_parsing(self):
         """Test $select parameter parsing"""
         parser = ODataParser("http://localhost/api/users?$select=id,name,email")
@@ -185,9 +239,12 @@ class TestODataURLParser:
         parser = ODataParser("http://localhost/api/users?$orderby=name asc,age desc")
         parser.run()
         
-        assert parser.orderby is not None
-        assert parser.orderby["name"] == "asc"
-        assert parser.orderby["age"] == "desc"
+        assert parser.orderby == [("name", "asc"), ("age", "desc")]
+
+        # same expression is parsed once
+        other = ODataParser("http://localhost/api/orders?$orderby=name asc,age desc&$top=1")
+        other.run()
+        assert other.orderby is parser.orderby
     
     def test_expand_parsing(self):
         """Test $expand parameter parsing"""
@@ -221,25 +278,29 @@ class TestODataURLParser:
         assert parser.search == "john"
     def test_complex_request(self):
         """Test several parameters together"""
-        parser = ODataParser("http://localhost/api/?$filter=users/id gt 7&$expand=users($select=id,email;$filter=not(contains(email,'x')) and created_at gt '2025-08-01T10:10:57';$orderby=id desc)&$top=1&$skip=0")
-        parser.run()
+        parser = _COMPLEX_PARSER
+
+        assert parser.top == 1 and parser.skip == 0
+        assert parser.filter.name == "gt" and parser.filter.a.path == ("users", "id")
+        assert parser.expand == [("users", "$select=id,email;$filter=not(contains(email,'x')) and "
+                                           "created_at gt '2025-08-01T10:10:57';$orderby=id desc")]
 
 class TestPeeweeODataQuery:
     """Test Peewee OData integration"""
     
     def test_basic_query(self):
         """Test basic entity collection query"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users")
 
         result = query_obj.query()
         
         assert query_obj.navigated_class == User
-        assert len(list(result)) == 3  # We created 3 users
+        assert result.count() == 3  # We created 3 users
     
     def test_single_entity_query(self):
         """Test single entity query with ID"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users(1)")
         result = list(query_obj.query())
         
@@ -249,7 +310,7 @@ class TestPeeweeODataQuery:
 
     def test_single_entity_query_full(self):
         """Test single entity query with ID"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users(id = 1)")
         result = list(query_obj.query())
         
@@ -258,75 +319,131 @@ class TestPeeweeODataQuery:
         assert result[0].name == "John Doe"
     
 
-    def test_filter_query(self):
-        """Test query with $filter"""
-        models = [User, Order, Product, OrderItem]
-        query_obj = PeeweeODataQuery(models, "/users?$filter=30 lt age")
-        result = list(query_obj.query())
-        
-        assert len(result) == 1
-        assert result[0].name == "Bob Wilson"
-        assert result[0].age == 35
-    
-    def test_filter_string_contains(self):
-        """Test string contains filter"""
-        models = [User, Order, Product, OrderItem]
-        query_obj = PeeweeODataQuery(models, "/users?$filter=contains(name,'John')")
+    @pytest.mark.parametrize("url,expected_names", [
+        ("/users?$filter=30 lt age", ["Bob Wilson"]),
+        ("/users?$filter=contains(name,'John')", ["John Doe"]),
+        ("/users?$filter=contains(name,'John') eq true", ["John Doe"]),
+        ("/users?$filter=is_active eq false", ["Bob Wilson"]),
+        ("/users?$filter=age gt 25 and is_active eq true", ["John Doe"]),
+    ])
+    def test_filter_query(self, url, expected_names):
+        """Test query with $filter (comparisons, string functions, booleans, AND)"""
+        query_obj = PeeweeODataQuery(MODELS, url)
         result = list(query_obj.query())
         
-        assert len(result) == 1
-        assert result[0].name == "John Doe"
+        assert [user.name for user in result] == expected_names
 
-    def test_filter_string_contains_with_eq(self):
-        """Test string contains filter"""
-        models = [User, Order, Product, OrderItem]
-        query_obj = PeeweeODataQuery(models, "/users?$filter=contains(name,'John') eq true")
-        result = list(query_obj.query())
+    def test_filter_query_values(self):
+        """Test filtered rows carry the converted values"""
+        result = list(PeeweeODataQuery(MODELS, "/users?$filter=is_active eq false").query())
         
-        assert len(result) == 1
-        assert result[0].name == "John Doe"
+        assert result[0].age == 35
+        assert result[0].is_active is False
 
-    def test_filter_boolean(self):
-        """Test boolean filter"""
-        models = [User, Order, Product, OrderItem]
-        query_obj = PeeweeODataQuery(models, "/users?$filter=is_active eq false")
+    def test_filter_fused_comparisons(self):
+        """Test comparisons of one field with several values become IN / NOT IN"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users?$filter=name eq 'Jane Smith' or age gt 32 or 'John Doe' eq name")
+        query = query_obj.query()
+
+        assert " IN " in query.sql()[0]
+        assert sorted(user.name for user in query) == ["Bob Wilson", "Jane Smith", "John Doe"]
+
+        query_obj = PeeweeODataQuery(models, "/users?$filter=id ne 1 and id ne 2 and age gt 20")
+        query = query_obj.query()
+
+        assert " NOT IN " in query.sql()[0]
+        assert [user.name for user in query] == ["Bob Wilson"]
+
+    def test_arithmetic_filter(self):
+        """Test arithmetic operators in filter"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users?$filter=(age mul 2) gt 65")
         result = list(query_obj.query())
-        
-        assert len(result) == 1
-        assert result[0].name == "Bob Wilson"
-        assert result[0].is_active is False
-    
-    def test_complex_filter(self):
-        """Test complex filter with AND"""
-        models = [User, Order, Product, OrderItem]
-        query_obj = PeeweeODataQuery(models, "/users?$filter=age gt 25 and is_active eq true")
+
+        assert [user.name for user in result] == ["Bob Wilson"]
+
+        query_obj = PeeweeODataQuery(models, "/users?$filter=(age mod 2) eq 1")
         result = list(query_obj.query())
-        
-        assert len(result) == 1
-        assert result[0].name == "John Doe"
+
+        assert sorted(user.name for user in result) == ["Bob Wilson", "Jane Smith"]
     
     def test_orderby_query(self):
         """Test query with $orderby"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users?$orderby=age desc")
-        result = list(query_obj.query())
+        # only the ages are read, as plain tuples
+        result = query_obj.query().select(User.age).tuples()
         
-        ages = [user.age for user in result]
-        assert ages == [35, 30, 25]  # Descending order
+        assert list(result) == [(35,), (30,), (25,)]  # Descending order
+
+    def test_cached_field_resolution(self):
+        """Test fields resolved by an earlier query register their joins and keep model restrictions"""
+        models = MODELS
+        for _ in range(2):
+            query_obj = PeeweeODataQuery(models, "/orders?$filter=user/name eq 'Jane Smith'")
+            result = list(query_obj.query())
+
+            assert query_obj.joins == [User]
+            assert [order.total for order in result] == [29.99]
+
+        query_obj = PeeweeODataQuery([Order], "/orders?$filter=user/name eq 'Jane Smith'")
+        with pytest.raises(ODataQueryException):
+            query_obj.query()
+
+    def test_cached_filter_expression(self, monkeypatch):
+        """Test filters are compiled once per model and filter shape, values are taken per query"""
+        models = MODELS
+        cache_size = len(peewee_qodata._FILTER_CACHE)
+        for name, totals in (("John Doe", [79.99, 1099.98]), ("Jane Smith", []), ("John Doe", [79.99, 1099.98])):
+            query_obj = PeeweeODataQuery(models, f"/orders?$filter=user/name eq '{name}' and total gt 50")
+            result = list(query_obj.query())
+
+            assert query_obj.joins == [User]
+            assert sorted(order.total for order in result) == totals
+
+        assert len(peewee_qodata._FILTER_CACHE) == cache_size + 1
+
+        # functions are called for every query, the compiled filter is reused with the current time
+        cache_size = len(peewee_qodata._FILTER_CACHE)
+        params = []
+        for moment in (datetime(2000, 1, 1), datetime(2100, 1, 1)):
+            monkeypatch.setattr(peewee_qodata, "datetime", _frozen_datetime(moment))
+            query_obj = PeeweeODataQuery(models, "/orders?$filter=order_date lt now()")
+            query = query_obj.query()
+            params.append(query.sql()[1])
+            assert query.count() == (0 if moment.year == 2000 else 3)
+
+        assert len(peewee_qodata._FILTER_CACHE) == cache_size + 1
+        assert params == [[datetime(2000, 1, 1)], [datetime(2100, 1, 1)]]
+
+    def test_orderby_related_fields(self):
+        """Test $orderby on several fields of a related model"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/orders?$orderby=user/age desc,user/name,total")
+        result = list(query_obj.query())
+
+        assert query_obj.joins == [User]
+        assert [order.total for order in result] == [79.99, 1099.98, 29.99]
     
     def test_select_query(self):
         """Test query with $select"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users?$select=id,name")
         result = list(query_obj.query())
         
         # The query should still return full objects but track selected fields
         assert len(result) == 3
         assert list(result[0].__data__.keys()) == ["id", "name"]
+
+        # repeated fields are selected once
+        query_obj = PeeweeODataQuery(models, "/users?$select=id,name,id")
+        query_obj.query()
+        assert list(query_obj.select_fields.values()) == [User.id, User.name]
     
     def test_top_skip_query(self):
         """Test query with $top and $skip"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users?$orderby=id&$top=2&$skip=1")
         result = list(query_obj.query())
         
@@ -336,45 +453,309 @@ class TestPeeweeODataQuery:
     
     def test_count_query(self):
         """Test query with $count"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users?$count=true")
         result = query_obj.query()
         
-        assert result == 3  # Count of users
+        assert query_obj.counted == 3  # Count of users
+        assert query_obj.to_odata_response(result)["@odata.count"] == 3
+
+        # count is returned for a single and for no matching entity as well
+        query_obj = PeeweeODataQuery(models, "/users?$filter=age eq 35&$count=true")
+        response = query_obj.to_odata_response(query_obj.query())
+        assert response["@odata.count"] == 1
+        assert response["value"][0]["name"] == "Bob Wilson"
+
+        query_obj = PeeweeODataQuery(models, "/users?$filter=age gt 100&$count=true")
+        assert query_obj.to_odata_response(query_obj.query()) == {"value": [], "@odata.count": 0}
     
+    def test_skiptoken_next_link(self):
+        """Test server side paging replaces only the skiptoken in the next link"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users?$filter=age gt 0&$select=id,name")
+        query_obj.set_skiptoken(2)
+        response = query_obj.to_odata_response(query_obj.query())
+
+        assert len(response["value"]) == 2
+        assert response["@odata.nextLink"] == "/users?$filter=age gt 0&$select=id,name&$skiptoken=1"
+
+        query_obj = PeeweeODataQuery(models, "/users?$skiptoken=0&$orderby=age desc")
+        query_obj.set_skiptoken(2)
+        response = query_obj.to_odata_response(query_obj.query())
+
+        assert response["@odata.nextLink"] == "/users?$skiptoken=1&$orderby=age desc"
+
+    def test_query_cache(self):
+        """Test compiled SQL is reused for the same url"""
+        models = MODELS
+        url = "/users?$filter=age gt 20 and contains(name,'o')&$orderby=age desc&$select=id,name,birth_date"
+
+        responses = []
+        for _ in range(2):
+            query_obj = PeeweeODataQuery(models, url)
+            query_obj.set_query_cache(True)
+            query = query_obj.query()
+            responses.append(query_obj.to_odata_response(query))
+
+        assert isinstance(query, ModelRaw)
+        assert query_obj.navigated_class == User
+        assert responses[0] == responses[1]
+        assert [row["name"] for row in responses[1]["value"]] == ["Bob Wilson", "John Doe"]
+
+        # expands are never cached
+        for _ in range(2):
+            query_obj = PeeweeODataQuery(models, "/users?$expand=orders")
+            query_obj.set_query_cache(True)
+            assert not isinstance(query_obj.query(), ModelRaw)
+
+    def test_query_cache_volatile_filter(self, monkeypatch):
+        """Test queries calling now() are built again with the current time"""
+        params = []
+        for moment in (datetime(2020, 1, 1), datetime(2021, 1, 1)):
+            monkeypatch.setattr(peewee_qodata, "datetime", _frozen_datetime(moment))
+            query_obj = PeeweeODataQuery(MODELS, "/users?$filter=birth_date lt now()")
+            query_obj.set_query_cache(True)
+            query = query_obj.query()
+
+            assert not isinstance(query, ModelRaw)
+            params.append(query.sql()[1])
+
+        assert params[0] != params[1]
+
+    def test_skiptoken_window_total(self):
+        """Test paging reads the total from the page query instead of a separate count"""
+        models = MODELS
+        total = User.select().count()
+        query_obj = PeeweeODataQuery(models, "/users")
+        query_obj.set_skiptoken(total)
+        query = query_obj.query()
+
+        assert "OVER" in query.sql()[0]
+        response = query_obj.to_odata_response(query)
+        assert len(response["value"]) == total
+        assert "@odata.nextLink" not in response
+        assert all("_odata_total" not in row for row in response["value"])
+
+        # joined queries fall back to the count query
+        query_obj = PeeweeODataQuery(models, "/orders?$filter=user/name ne ''")
+        query_obj.set_skiptoken(2)
+        query = query_obj.query()
+
+        assert "OVER" not in query.sql()[0]
+        response = query_obj.to_odata_response(query)
+        assert response["@odata.nextLink"] == "/orders?$filter=user/name ne ''&$skiptoken=1"
+
+    def test_skiptoken_keeps_client_window(self):
+        """Test $top and $skip are kept when the result fits in a skiptoken page"""
+        models = MODELS
+        total = User.select().count()
+        for url, expected in (("/users?$top=2", 2), ("/users?$skip=1", total - 1)):
+            query_obj = PeeweeODataQuery(models, url)
+            query_obj.set_skiptoken(total + 5)
+            response = query_obj.to_odata_response(query_obj.query())
+
+            assert len(response["value"]) == expected
+            assert "@odata.nextLink" not in response
+
     def test_navigation_query(self):
         """Test navigation to related entities"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users(1)/orders")
         result = list(query_obj.query())
         
         assert query_obj.navigated_class == Order
         assert len(result) == 2  # User 1 has 2 orders
         assert all(order.user_id == 1 for order in result)
-    
+
+    def test_navigation_keys_in_join(self):
+        """Test keys of parent entities are applied in their joins"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users(1)/orders(2)/items")
+        query = query_obj.query()
+        sql, params = query.sql()
+
+        assert 'ON (("t2"."user_id" = "t3"."id") AND ("t3"."id" = ?))' in sql
+        assert [item.unit_price for item in query] == [79.99]
+
+        query_obj = PeeweeODataQuery(models, "/users(2)/orders(2)/items")
+        assert list(query_obj.query()) == []
+
     def test_expand_query(self):
         """Test query with $expand"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users?$expand=orders")
         result = list(query_obj.query())
         
         assert len(result) == 3
         assert len(query_obj.expands) == 1
-        assert query_obj.expands[0][1] == "orders"  # expand field name
+        assert query_obj.expands["orders"][1] == "orders"  # expand field name
+
+    def test_expand_foreign_key(self):
+        """Test $expand of a foreign key inlines the related entity"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/orders?$expand=user")
+        response = query_obj.to_odata_response(query_obj.query())
+
+        assert [order["user"]["name"] for order in response["value"]] == ["John Doe", "John Doe", "Jane Smith"]
+        assert response["value"][0]["@odata.id"] == "orders(1)"
+
+    def test_expand_null_foreign_key(self):
+        """Test expanded foreign keys keep rows without a related entity (LEFT OUTER join)"""
+        class Note(Model):
+            text = CharField()
+            user = ForeignKeyField(User, null=True, backref='+')
+
+            class Meta:
+                database = test_db
+
+        test_db.create_tables([Note])
+        try:
+            # related user, no user, missing user (foreign keys are not enforced)
+            Note.insert_many([{"text": "a", "user": 1}, {"text": "b", "user": None},
+                              {"text": "c", "user": 999}]).execute()
+            for url, expand_complex in (("/notes?$expand=user&$orderby=id", False), ("/notes?$orderby=id", True)):
+                query_obj = PeeweeODataQuery([User, Note], url)
+                query_obj.set_expand_complex(expand_complex)
+                query = query_obj.query()
+                response = query_obj.to_odata_response(query)
+
+                assert "LEFT OUTER JOIN" in query.sql()[0]
+                assert [note["text"] for note in response["value"]] == ["a", "b", "c"]
+                # a missing entity keeps the key, as when foreign keys were loaded per row
+                assert [note["user"] for note in response["value"]][1:] == [None, 999]
+                assert response["value"][0]["user"]["name"] == "John Doe"
+        finally:
+            test_db.drop_tables([Note])
+
+    def test_expand_several_foreign_keys(self):
+        """Test foreign keys are expanded from joined rows"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/orderitems?$expand=order,product")
+        query = query_obj.query()
+        response = query_obj.to_odata_response(query)
+
+        assert query.sql()[0].count("LEFT OUTER JOIN") == 2
+        assert response["value"][0]["order"]["description"] == "First order"
+        assert response["value"][0]["product"]["name"] == "Laptop"
+
+        query_obj = PeeweeODataQuery(models, "/orderitems")
+        query_obj.set_expand_complex(True)
+        query = query_obj.query()
+
+        assert query.sql()[0].count("LEFT OUTER JOIN") == 2
+        assert query_obj.to_odata_response(query) == response
+
+    def test_expand_foreign_keys_to_same_model(self):
+        """Test foreign keys to one model and to the model itself are expanded on their own columns"""
+        class Message(Model):
+            text = CharField()
+            sender = ForeignKeyField(User, backref='+')
+            recipient = ForeignKeyField(User, null=True, backref='+')
+
+            class Meta:
+                database = test_db
+
+        class Node(Model):
+            name = CharField()
+            parent = ForeignKeyField('self', null=True, backref='+')
+
+            class Meta:
+                database = test_db
+
+        test_db.create_tables([Message, Node])
+        try:
+            Message.insert_many([{"text": "a", "sender": 1, "recipient": 2},
+                                 {"text": "b", "sender": 2, "recipient": None}]).execute()
+            root = Node.create(name="root")
+            Node.create(name="child", parent=root)
+            for expand_complex in (False, True):
+                query_obj = PeeweeODataQuery([User, Message], "/messages?$expand=sender,recipient&$orderby=id")
+                query_obj.set_expand_complex(expand_complex)
+                response = query_obj.to_odata_response(query_obj.query())
+
+                assert [(message["sender"]["name"], message["recipient"] and message["recipient"]["name"])
+                        for message in response["value"]] == [("John Doe", "Jane Smith"), ("Jane Smith", None)]
+
+                query_obj = PeeweeODataQuery([Node], "/nodes?$expand=parent&$orderby=id")
+                query_obj.set_expand_complex(expand_complex)
+                response = query_obj.to_odata_response(query_obj.query())
+
+                assert [node["name"] for node in response["value"]] == ["root", "child"]
+                assert response["value"][0]["parent"] is None
+                assert response["value"][1]["parent"]["name"] == "root"
+        finally:
+            test_db.drop_tables([Message, Node])
+
+    def test_nested_expand_query(self):
+        """Test nested $expand is prefetched and serialized for every row"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users?$expand=orders($expand=items;$orderby=id)")
+        response = query_obj.to_odata_response(query_obj.query())
+
+        users = {user["name"]: user for user in response["value"]}
+        assert [len(order["items"]) for order in users["John Doe"]["orders"]] == [2, 1]
+        assert [len(order["items"]) for order in users["Jane Smith"]["orders"]] == [1]
+        assert users["Bob Wilson"]["orders"] == []
     
     def test_search_functionality(self):
         """Test search functionality"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users?$search=john")
         query_obj.set_search_fields(["name", "email"])
-        result = list(query_obj.query())
+        result = query_obj.query()
         
         # Should find users with 'john' in name or email
-        assert len(result) >= 1
+        assert result.count() >= 1
+
+    def test_search_any_field(self):
+        """Test search matches when any of the search fields contains the string"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users?$search=smith")
+        query_obj.set_search_fields(["name", "email"])
+        result = list(query_obj.query())
+
+        assert [user.name for user in result] == ["Jane Smith"]
+
+    def test_search_regex(self):
+        """Test search with regex instead of LIKE"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users?$search=J.hn")
+        query_obj.set_search_fields(["name", "email"])
+        query_obj.set_regex_search(True)
+
+        # search string is matched literally
+        assert list(query_obj.query()) == []
+
+        query_obj = PeeweeODataQuery(models, "/users?$search=JOHN")
+        query_obj.set_search_fields(["name", "email"])
+        query_obj.set_regex_search(True)
+        assert [user.name for user in query_obj.query()] == ["John Doe"]
+
+    @pytest.mark.skipif(not _fts5_trigram_available(), reason="SQLite without FTS5 trigram tokenizer")
+    def test_search_fts(self):
+        """Test search in an FTS5 table indexing the model"""
+        test_db.execute_sql('CREATE VIRTUAL TABLE user_fts USING fts5(name, email, content="user", '
+                            'content_rowid="id", tokenize="trigram")')
+        test_db.execute_sql("INSERT INTO user_fts(user_fts) VALUES('rebuild')")
+        try:
+            query_obj = PeeweeODataQuery(MODELS, "/users?$search=SMITH&$select=id,name")
+            query_obj.set_fts_search("user_fts")
+            assert [user.name for user in query_obj.query()] == ["Jane Smith"]
+
+            # combined with other conditions, quotes do not break the FTS query
+            query_obj = PeeweeODataQuery(MODELS, "/users?$search=example.com&$filter=age gt 26&$orderby=id")
+            query_obj.set_fts_search("user_fts")
+            assert [user.name for user in query_obj.query()] == ["John Doe", "Bob Wilson"]
+
+            query_obj = PeeweeODataQuery(MODELS, "/users?$search=jo\"hn")
+            query_obj.set_fts_search("user_fts")
+            assert list(query_obj.query()) == []
+        finally:
+            test_db.execute_sql("DROP TABLE user_fts")
     
     def test_create_entity(self):
         """Test entity creation"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users")
         
         new_user_data = {
@@ -394,7 +775,7 @@ class TestPeeweeODataQuery:
     
     def test_update_entity(self):
         """Test entity update"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users(1)")
         
         update_data = {
@@ -410,10 +791,40 @@ class TestPeeweeODataQuery:
         # Restore original data
         restore_data = {"name": "John Doe", "age": 30}
         query_obj.update(restore_data, patch=True)
-    
+
+    def test_update_entity_where(self):
+        """Test update of an entity excluded by where conditions or restrictions"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users(1)")
+        with pytest.raises(ODataQueryException):
+            query_obj.update({"age": 99}, where=[User.age > 50], patch=True)
+
+        query_obj = PeeweeODataQuery(models, "/users(1)")
+        query_obj.add_restricition(User, [User.is_active == False])
+        with pytest.raises(ODataQueryException):
+            query_obj.delete()
+
+        assert User.get_by_id(1).age == 30
+
+    def test_update_navigated_entity(self):
+        """Test update of an entity addressed through its parent"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users(1)/orders(2)")
+        updated_order = query_obj.update({"description": "Changed"}, patch=True)
+
+        assert updated_order.id == 2
+        assert Order.get_by_id(2).description == "Changed"
+
+        query_obj = PeeweeODataQuery(models, "/users(2)/orders(2)")
+        with pytest.raises(ODataQueryException):
+            query_obj.update({"description": "Other"}, patch=True)
+
+        query_obj = PeeweeODataQuery(models, "/users(1)/orders(2)")
+        query_obj.update({"description": "Second order"}, patch=True)
+
     def test_delete_entity(self):
         """Test entity deletion"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         
         # First create a user to delete
         test_user = User.create(name="To Delete", email="delete@example.com", age=40)
@@ -427,9 +838,43 @@ class TestPeeweeODataQuery:
         with pytest.raises(User.DoesNotExist):
             User.get_by_id(test_user.id)
     
+    @pytest.mark.parametrize("direct", [False, True])
+    def test_mutations_with_returning(self, monkeypatch, direct):
+        """Test update and delete, as single statements only when enabled and database supports RETURNING"""
+        monkeypatch.setattr(test_db, "returning_clause", True)
+        # instance methods run only without direct mutations
+        calls = []
+        monkeypatch.setattr(User, "save", lambda self, *args, **kwargs: calls.append("save") or Model.save(self, *args, **kwargs))
+        monkeypatch.setattr(User, "delete_instance", lambda self, *args, **kwargs: calls.append("delete") or Model.delete_instance(self, *args, **kwargs))
+        models = MODELS
+        test_user = User.create(name="To Change", email="change@example.com", age=40)
+        calls.clear()
+
+        query_obj = PeeweeODataQuery(models, f"/users({test_user.id})")
+        query_obj.set_direct_mutations(direct)
+        updated_user = query_obj.update({"age": 41}, patch=True)
+
+        assert updated_user.age == 41
+        assert updated_user.name == "To Change"
+        assert User.get_by_id(test_user.id).age == 41
+
+        query_obj = PeeweeODataQuery(models, f"/users({test_user.id})")
+        query_obj.set_direct_mutations(direct)
+        deleted_user = query_obj.delete()
+
+        assert deleted_user.name == "To Change"
+        with pytest.raises(User.DoesNotExist):
+            User.get_by_id(test_user.id)
+        assert calls == ([] if direct else ["save", "delete"])
+
+        query_obj = PeeweeODataQuery(models, f"/users({test_user.id})")
+        query_obj.set_direct_mutations(direct)
+        with pytest.raises(ODataQueryException):
+            query_obj.delete()
+
     def test_to_odata_response(self):
         """Test OData response serialization"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users")
         result = list(query_obj.query())
         
@@ -444,10 +889,79 @@ class TestPeeweeODataQuery:
         assert "name" in first_user
         assert "email" in first_user
         assert "@odata.id" in first_user
+
+        # a not yet executed query is read as dicts, the response is the same
+        query_obj = PeeweeODataQuery(models, "/users")
+        assert query_obj.to_odata_response(query_obj.query()) == odata_response
     
+    def test_stream_response(self):
+        """Test streamed response yields the same rows and encodes to JSON"""
+        models = MODELS
+        query_obj = PeeweeODataQuery(models, "/users?$expand=orders")
+        expected = query_obj.to_odata_response(query_obj.query())
+
+        query_obj = PeeweeODataQuery(models, "/users?$expand=orders")
+        response = query_obj.to_odata_response(query_obj.query(), stream=True)
+        assert not isinstance(response["value"], list)
+        assert list(response["value"]) == expected["value"]
+
+        query_obj = PeeweeODataQuery(models, "/users?$orderby=id")
+        query_obj.set_skiptoken(2)
+        response = query_obj.to_odata_response(query_obj.query(), stream=True)
+        encoded = json.loads("".join(iter_json(response)))
+
+        assert [user["name"] for user in encoded["value"]] == ["John Doe", "Jane Smith"]
+        assert encoded["value"][0]["birth_date"] == "1993-05-15"
+        assert encoded["@odata.nextLink"] == "/users?$orderby=id&$skiptoken=1"
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_single_entity_response(self, stream):
+        """Test a single entity is returned as is, with and without streaming"""
+        query_obj = PeeweeODataQuery(MODELS, "/users(1)")
+        response = query_obj.to_odata_response(query_obj.query(), stream=stream)
+
+        assert "value" not in response
+        assert response["id"] == 1 and response["name"] == "John Doe"
+
+        # the count keeps the collection shape
+        query_obj = PeeweeODataQuery(MODELS, "/users(1)?$count=true")
+        response = query_obj.to_odata_response(query_obj.query(), stream=stream)
+        assert [user["name"] for user in response["value"]] == ["John Doe"]
+        assert response["@odata.count"] == 1
+
+    @pytest.mark.parametrize("use_orjson", [True, False])
+    def test_to_odata_json(self, use_orjson, monkeypatch):
+        """Test JSON output matches the response with and without orjson"""
+        if use_orjson:
+            pytest.importorskip("orjson")
+        else:
+            monkeypatch.setattr(peewee_qodata, "orjson", None)
+        models = MODELS
+        url = "/users?$expand=orders&$select=id,name,birth_date&$count=true"
+        query_obj = PeeweeODataQuery(models, url)
+        encoded = json.loads(query_obj.to_odata_json(query_obj.query()))
+
+        query_obj = PeeweeODataQuery(models, url)
+        expected = query_obj.to_odata_response(query_obj.query())
+
+        assert encoded["@odata.count"] == expected["@odata.count"] == 3
+        assert len(encoded["value"]) == 3
+        assert encoded["value"][0]["birth_date"] == "1993-05-15"
+        assert [len(user["orders"]) for user in encoded["value"]] == [len(user["orders"]) for user in expected["value"]]
+        assert encoded["value"][0]["orders"][0]["order_date"] == expected["value"][0]["orders"][0]["order_date"].isoformat()
+
+        # single entity has the same shape as in to_odata_response
+        query_obj = PeeweeODataQuery(models, "/users(1)")
+        encoded = json.loads(query_obj.to_odata_json(query_obj.query()))
+        query_obj = PeeweeODataQuery(models, "/users(1)")
+        expected = query_obj.to_odata_response(query_obj.query())
+
+        assert encoded == json.loads("".join(iter_json(expected)))
+        assert encoded["name"] == "John Doe" and "value" not in encoded
+
     def test_restrictions(self):
         """Test model restrictions"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users")
         
         # Add restriction to only show active users
@@ -461,7 +975,7 @@ class TestPeeweeODataQuery:
     
     def test_hidden_fields(self):
         """Test hidden fields functionality"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         query_obj = PeeweeODataQuery(models, "/users")
         query_obj.set_hidden_fields(["email"])
         
@@ -483,6 +997,16 @@ class TestPeeweeODataMeta:
         assert PeeweeODataMeta.peewee_to_odata_type(BooleanField()) == 'Edm.Boolean'
         assert PeeweeODataMeta.peewee_to_odata_type(DateField()) == 'Edm.Date'
         assert PeeweeODataMeta.peewee_to_odata_type(DateTimeField()) == 'Edm.DateTimeOffset'
+
+        # subclasses get the type of their closest mapped base
+        class UpperCharField(CharField):
+            pass
+
+        assert PeeweeODataMeta.peewee_to_odata_type(UpperCharField()) == 'Edm.String'
+        assert PeeweeODataMeta.peewee_to_odata_type(AutoField()) == 'Edm.Int32'
+        assert PeeweeODataMeta.peewee_to_odata_type(BigAutoField()) == 'Edm.Int64'
+        assert PeeweeODataMeta.peewee_to_odata_type(TimestampField()) == 'Edm.DateTimeOffset'
+        assert PeeweeODataMeta.peewee_to_odata_type(BareField()) == 'Edm.String'
     
     def test_nullable_field_detection(self):
         """Test nullable field detection"""
@@ -504,23 +1028,34 @@ class TestPeeweeODataMeta:
     
     def test_metadata_generation(self):
         """Test XML metadata generation"""
-        models = [User, Order, Product, OrderItem]
+        models = MODELS
         metadata_xml = PeeweeODataMeta.create_multi_model_metadata(
             models,
             namespace="TestNamespace",
             container_name="TestContainer"
         )
         
-        # Basic XML structure checks
-        assert "<?xml" in metadata_xml
-        assert "TestNamespace" in metadata_xml
-        assert "TestContainer" in metadata_xml
-        assert "EntityType" in metadata_xml
-        assert "EntitySet" in metadata_xml
-        
-        # Check that all models are included
-        for model in models:
-            assert model.__name__ in metadata_xml
+        # Basic XML structure and all models, found in one scan of the document
+        needles = ["<?xml", "TestNamespace", "TestContainer", "EntityType", "EntitySet"]
+        needles += [model.__name__ for model in models]
+        # longest first, so OrderItem is not consumed as Order
+        pattern = "|".join(map(re.escape, sorted(needles, key=len, reverse=True)))
+        found = set(re.findall(pattern, metadata_xml))
+        assert found >= set(needles)
+
+    def test_metadata_cache(self):
+        """Test metadata documents are reused for the same arguments"""
+        models = [User, Order]
+        configs = {'User': {'allowed_fields': ['id', 'name']}}
+        metadata_xml = PeeweeODataMeta.create_multi_model_metadata(models, field_configs=configs)
+
+        assert PeeweeODataMeta.create_multi_model_metadata(models, field_configs=configs) is metadata_xml
+        assert '"email"' not in metadata_xml
+        assert '"email"' in PeeweeODataMeta.create_multi_model_metadata(models)
+
+        PeeweeODataMeta.clear_metadata_cache()
+        rebuilt = PeeweeODataMeta.create_multi_model_metadata(models, field_configs=configs)
+        assert rebuilt is not metadata_xml and rebuilt == metadata_xml
 
 class TestErrorHandling:
     """Test error handling scenarios"""